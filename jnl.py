@@ -8,10 +8,33 @@
 ###
 import sys
 import os
+import stat
 import sqlite3 as sql
 import argparse
 import datetime
 import time
+import json
+import csv
+import itertools
+import shlex
+import re
+import io
+import contextlib
+import bisect
+import codecs
+import difflib
+import cmd as cmd_mod
+import socket
+import socketserver
+import signal
+import random
+import zlib
+import tempfile
+try:
+    # Python can be built without lzma; then only zlib is offered for page compression.
+    import lzma
+except ImportError:
+    lzma = None
 ###
 ########################################################################################################################
 ### End imports
@@ -95,6 +118,9 @@ page = KEY_page
 non = KEY_emdash
 todo = KEY_check
 
+# Bullet printed for each item_type.
+bullets = {'LOG': dot, 'NOTE': note, 'IDEA': idea, 'QUOT': quot, 'TODO': todo, 'B_VS': KEY_b_vs}
+
 legend = '''
 Legend
 ===============
@@ -111,6 +137,58 @@ null =>     [?]
 '''
 
 cmd = str
+
+# Number of rows pulled from the cursor at a time by the streaming listings.
+FETCH_ROWS = 500
+
+# How long (ms) a command waits for another process's write lock on the journal before it gives up (--busy_timeout).
+BUSY_TIMEOUT = 5000
+# A write that still finds the journal locked is tried again this many times, WRITE_BACKOFF seconds apart at first and
+# doubling each time.
+WRITE_RETRIES = 5
+WRITE_BACKOFF = 0.05
+
+# --pg streams the file into the page, and --show_pg/--show_todo stream the page out, this many bytes at a time.
+PAGE_CHUNK = 1 << 16
+
+# Page compression codecs (page.codec): name -> (compressor factory, decompressor factory).
+PAGE_CODECS = {'zlib': (lambda: zlib.compressobj (9), zlib.decompressobj)}
+CODEC_ERRORS = (zlib.error,)
+if lzma:
+    PAGE_CODECS['lzma'] = (lzma.LZMACompressor, lzma.LZMADecompressor)
+    CODEC_ERRORS += (lzma.LZMAError,)
+
+# SQL for the text of a page row, whatever its codec. pg_text is the Python function every connection registers.
+PAGE_TEXT_SQL = "CAST(CASE WHEN codec IS NULL THEN data ELSE pg_text(data, codec) END AS TEXT)"
+
+# Number of pages --compact_pages recompresses per transaction.
+COMPACT_PAGES = 200
+
+# Page history (page_rev). A replaced page is kept as a reverse line delta against the page that replaced it, except
+# every HISTORY_KEYFRAME-th revision, which is a full zlib copy, so rebuilding a revision never applies more than
+# HISTORY_KEYFRAME - 1 deltas. Pages over HISTORY_DIFF_MAX bytes are not diffed and are kept as they were stored.
+HISTORY_KEYFRAME = 32
+HISTORY_DIFF_MAX = 1 << 20
+
+# Number of records --import writes per transaction. Big enough that commits are not the bottleneck, small enough that
+# a bad batch does not hold the write lock for long.
+IMPORT_ROWS = 5000
+
+# Options (by dest) that change a journal. --replay re-runs commands that use one of them; anything else only showed
+# data and is just copied into cmd_line.
+WRITE_OPTIONS = ('is_add', 'is_done', 'dt', 'tstmp', 'is_edit', 'is_pg', 'is_rm', 'import_file')
+
+# Options (by dest -> CLI option) that commit in transactions of their own. None of them can share a command with
+# another change, which would be committed, or rolled back, along with them.
+OWN_TRANSACTION_OPTIONS = {'import_file': '--import', 'is_compact': '--compact_pages', 'is_epoch': '--epoch_timestamps'}
+
+# --add options (by dest) and the item type each one creates, in the order run_command adds them. Every type the item
+# table accepts, except NONE, is here; --shell, --replay and Journal.add_items all work from this table.
+ADD_OPTIONS = (('log', 'LOG'), ('note', 'NOTE'), ('idea', 'IDEA'), ('quot', 'QUOT'), ('todo', 'TODO'), ('bvs', 'B_VS'))
+
+# Journal file header. Every journal is stamped with these so it can be validated by reading the database header
+# instead of probing the tables. JNL_APPLICATION_ID spells 'JNL1'.
+JNL_APPLICATION_ID = 0x4A4E4C31
 ###
 ########################################################################################################################
 ### External variables
@@ -252,6 +330,214 @@ COMMIT;
 ### Initialize DB
 ########################################################################################################################
 
+########################################################################################################################
+### Schema migrations
+########################################################################################################################
+###
+# SQLInitialize creates the version 1 schema. Each entry below upgrades a journal from the previous version to
+# 'version' and is applied in order, in its own transaction, by Journal.migrate. The script is SQL, or a function
+# given the cursor that returns the SQL. PRAGMA user_version holds the version a journal file is at. Never edit a
+# migration once it has shipped - add a new one.
+#
+# STRICT tables need SQLite 3.37. On older libraries the tables are rebuilt without it.
+STRICT = ' STRICT' if sql.sqlite_version_info >= (3, 37, 0) else ''
+
+# Full-text index over item text and page data for --search. item_fts.rowid is the item_id. The triggers keep it in
+# step with every insert, edit, page change and --rm.
+SQLSearchIndex = '''
+CREATE VIRTUAL TABLE item_fts USING fts5(item, data, tokenize = 'unicode61 remove_diacritics 2');
+INSERT INTO item_fts(rowid, item, data)
+  SELECT item.item_id, item.item, COALESCE((SELECT group_concat(data, char(10)) FROM page WHERE page.item_id = item.item_id), '')
+  FROM item WHERE item.item_type IS NOT 'NONE';
+CREATE TRIGGER item_fts_insert AFTER INSERT ON item WHEN new.item_type IS NOT 'NONE' BEGIN
+  INSERT INTO item_fts(rowid, item, data)
+    VALUES (new.item_id, new.item, COALESCE((SELECT data FROM page WHERE item_id = new.item_id), ''));
+END;
+CREATE TRIGGER item_fts_update AFTER UPDATE OF item ON item BEGIN
+  UPDATE item_fts SET item = new.item WHERE rowid = new.item_id;
+END;
+CREATE TRIGGER item_fts_delete AFTER DELETE ON item BEGIN
+  DELETE FROM item_fts WHERE rowid = old.item_id;
+END;
+CREATE TRIGGER page_fts_insert AFTER INSERT ON page BEGIN
+  UPDATE item_fts SET data = new.data WHERE rowid = new.item_id;
+END;
+CREATE TRIGGER page_fts_update AFTER UPDATE OF data ON page BEGIN
+  UPDATE item_fts SET data = new.data WHERE rowid = new.item_id;
+END;
+CREATE TRIGGER page_fts_delete AFTER DELETE ON page BEGIN
+  UPDATE item_fts SET data = '' WHERE rowid = old.item_id;
+END;
+'''
+
+def search_migration (cur: sql.Cursor) -> str:
+    """The --search index needs FTS5 compiled into SQLite. Without it the journal is upgraded without the index."""
+    cur.execute ('PRAGMA compile_options')
+    if 'ENABLE_FTS5' not in [r[0] for r in cur.fetchall()]:
+        return ''
+    return SQLSearchIndex
+
+# A page streamed in by --pg is a BLOB that starts out as zeroblob(size) and is written in place, which the page
+# triggers would index while it is still all zeros. From version 7 they index TEXT pages only, and the code that writes
+# a BLOB page brings item_fts up to date itself once the page is complete.
+SQLPageBlobTriggers = '''
+DROP TRIGGER page_fts_insert;
+DROP TRIGGER page_fts_update;
+CREATE TRIGGER page_fts_insert AFTER INSERT ON page WHEN typeof(new.data) IS NOT 'blob' BEGIN
+  UPDATE item_fts SET data = new.data WHERE rowid = new.item_id;
+END;
+CREATE TRIGGER page_fts_update AFTER UPDATE OF data ON page WHEN typeof(new.data) IS NOT 'blob' BEGIN
+  UPDATE item_fts SET data = new.data WHERE rowid = new.item_id;
+END;
+'''
+
+def page_blob_migration (cur: sql.Cursor) -> str:
+    """Only a journal with the --search index has page triggers to change."""
+    cur.execute ("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'page_fts_insert'")
+    if not cur.fetchall():
+        return ''
+    return SQLPageBlobTriggers
+
+def page_key_migration (cur: sql.Cursor) -> str:
+    """Keep only the newest page row of each item, then key page by item_id. Deleting the extra rows clears the page
+    text of their item in item_fts, so with the --search index those items are indexed again from the row left."""
+    cur.execute ("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'item_fts'")
+    reindex = ''
+    if cur.fetchall():
+        reindex = '''
+UPDATE item_fts SET data = COALESCE((SELECT {} FROM page WHERE page.item_id = item_fts.rowid), '')
+  WHERE rowid IN (SELECT item_id FROM page_dup);'''.format (PAGE_TEXT_SQL)
+    return '''
+CREATE TEMP TABLE page_dup AS SELECT item_id FROM page WHERE item_id IS NOT NULL GROUP BY item_id HAVING count(*) > 1;
+DELETE FROM page WHERE item_id IN (SELECT item_id FROM page_dup)
+  AND rowid NOT IN (SELECT MAX(rowid) FROM page WHERE item_id IN (SELECT item_id FROM page_dup) GROUP BY item_id);''' + reindex + '''
+DROP TABLE page_dup;
+DROP INDEX IF EXISTS page_id;
+CREATE UNIQUE INDEX page_item ON page(item_id);
+'''
+
+MIGRATIONS = [
+    (2, 'item as a STRICT table', '''
+CREATE TABLE item_new (
+  item_id INTEGER PRIMARY KEY AUTOINCREMENT,
+  item_type TEXT CHECK (item_type IN ('NONE','TODO','LOG','NOTE','IDEA','QUOT','B_VS')),
+  dtime TEXT,
+  updt TEXT,
+  is_pg INTEGER,
+  is_done INTEGER,
+  item TEXT
+)''' + STRICT + ''';
+INSERT INTO item_new
+  SELECT item_id, CAST(item_type AS TEXT), CAST(dtime AS TEXT), CAST(updt AS TEXT),
+         CAST(is_pg AS INTEGER), CAST(is_done AS INTEGER), CAST(item AS TEXT)
+  FROM item;
+-- Keep the AUTOINCREMENT high-water mark, which can be above MAX(item_id) after an --rm.
+UPDATE sqlite_sequence SET seq = (SELECT seq FROM sqlite_sequence WHERE name = 'item') WHERE name = 'item_new';
+DROP TABLE item;
+ALTER TABLE item_new RENAME TO item;
+'''),
+    (3, 'covering indexes for listings, cmd_line and archive', '''
+CREATE INDEX IF NOT EXISTS item_type_done_dtime ON item(item_type, is_done, dtime);
+CREATE INDEX IF NOT EXISTS cmd_line_dtime ON cmd_line(dtime);
+CREATE INDEX IF NOT EXISTS archive_id ON archive(item_id);
+'''),
+    (4, 'indexes for newest-first listings', '''
+CREATE INDEX IF NOT EXISTS item_dtime ON item(dtime);
+CREATE INDEX IF NOT EXISTS item_type_done_id ON item(item_type, is_done, item_id);
+'''),
+    (5, 'full-text search index', search_migration),
+    # WAL lets readers and a writer work at once. The journal mode cannot change inside a transaction, so migrate
+    # sets it before taking the lock for this step, which only records the version. It sticks to the file.
+    (6, 'WAL journaling', ''),
+    (7, 'page triggers leave BLOB pages to the writer', page_blob_migration),
+    # NULL is a plain page; otherwise the PAGE_CODECS name data is compressed with.
+    (8, 'page compression codec', '''
+ALTER TABLE page ADD COLUMN codec TEXT;
+'''),
+    # Old revisions of each page: rev 1 is the first page an item had, and the page table holds the one after the
+    # last rev. A row is either a delta (JSON, see page_delta) or a full copy in data/codec, as in page. dtime is when
+    # the revision was written, in whatever format the journal's timestamps use.
+    (9, 'page revision history', '''
+CREATE TABLE page_rev (
+  item_id INTEGER,
+  rev INTEGER,
+  dtime,
+  delta TEXT,
+  data,
+  codec TEXT,
+  PRIMARY KEY (item_id, rev)
+);
+'''),
+    # One page row per item, so --pg can upsert it.
+    (10, 'page keyed by item_id', page_key_migration),
+]
+
+# Optional compact timestamp format, set up by --epoch_timestamps. Every timestamp column becomes an INTEGER holding
+# UTC epoch seconds; text 'YYYY-MM-DD HH:MM:SS' values are taken as local time. Rendering back to local time happens
+# only at output (fmt_ts). Each entry is (table, new table DDL, columns in table order).
+EPOCH_COLUMNS = ('dtime', 'updt', 'archdt')
+EPOCH_TABLES = [
+    ('item', '''CREATE TABLE item_new (
+  item_id INTEGER PRIMARY KEY AUTOINCREMENT,
+  item_type TEXT CHECK (item_type IN ('NONE','TODO','LOG','NOTE','IDEA','QUOT','B_VS')),
+  dtime INTEGER,
+  updt INTEGER,
+  is_pg INTEGER,
+  is_done INTEGER,
+  item TEXT
+)''' + STRICT, ('item_id', 'item_type', 'dtime', 'updt', 'is_pg', 'is_done', 'item')),
+    ('page', '''CREATE TABLE page_new (
+  item_id INTEGER,
+  dtime INTEGER,
+  updt INTEGER,
+  data TEXT,
+  codec TEXT
+)''', ('item_id', 'dtime', 'updt', 'data', 'codec')),
+    ('page_rev', '''CREATE TABLE page_rev_new (
+  item_id INTEGER,
+  rev INTEGER,
+  dtime INTEGER,
+  delta TEXT,
+  data,
+  codec TEXT,
+  PRIMARY KEY (item_id, rev)
+)''', ('item_id', 'rev', 'dtime', 'delta', 'data', 'codec')),
+    ('cmd_line', '''CREATE TABLE cmd_line_new (
+    dtime INTEGER,
+    cmd TEXT
+)''', ('dtime', 'cmd')),
+    ('hours', '''CREATE TABLE hours_new (
+  item_id INTEGER,
+  dtime INTEGER,
+  hours INTEGER,
+  minutes INTEGER
+)''', ('item_id', 'dtime', 'hours', 'minutes')),
+    ('archive', '''CREATE TABLE archive_new (
+    item_id INTEGER,
+    item_type CHAR (4) CHECK (item_type IN ('NONE','TODO','LOG','NOTE','IDEA','QUOT','B_VS')),
+    dtime INTEGER,
+    updt INTEGER,
+    archdt INTEGER,
+    item TEXT,
+    pg_data TEXT
+)''', ('item_id', 'item_type', 'dtime', 'updt', 'archdt', 'item', 'pg_data')),
+]
+
+def epoch_sql (col: str) -> str:
+    """SQL converting a local 'YYYY-MM-DD HH:MM:SS' text column to UTC epoch seconds. Anything else becomes NULL."""
+    return "CASE WHEN {0} GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]*' THEN CAST(strftime('%s', {0}, 'utc') AS INTEGER) END".format (col)
+
+# The migration that turns on WAL journaling, see migrate.
+WAL_VERSION = 6
+
+# Version of a freshly initialized journal and the version this jnl brings every journal up to.
+JNL_BASE_VERSION = 1
+JNL_USER_VERSION = MIGRATIONS[-1][0]
+###
+########################################################################################################################
+### Schema migrations
+########################################################################################################################
+
 ########################################################################################################################
 ### Main help
 ########################################################################################################################
@@ -733,42 +1019,6 @@ is_ls
 ########################################################################################################################
 ###
 
-########################################################################################################################
-### stamp_command
-########################################################################################################################
-def stamp_command (fn: str, cmd: str) -> bool:
-    """Stamp the command-line into the cmd_line table."""
-    # Open journal file
-    try:
-        con = sql.connect (fn)
-        cur = con.cursor()
-    except sql.Error as em:
-        print ("*** SQLite error opening Journal file: {}".format (em))
-        return False
-
-    # Verify it is a sqlite journal file.
-    try:
-        cur.execute('SELECT * FROM item WHERE item_type = "NONE"')
-    except sql.Error as em:
-        print ("***Error: {} '{}'".format(args.filename, em))
-        cur.close()
-        con.close()
-        return False
-
-    # Good sqlite file. Proceed.
-    s = """BEGIN TRANSACTION; INSERT INTO cmd_line VALUES (datetime('now','localtime'),'{}'); COMMIT;""".format(cmd)
-    try:
-        cur.executescript(s)
-    except sql.Error as em:
-        print ("*** Error: {} '{}'".format(s, em))
-        cur.close()
-        con.close()
-        return False
-    # Done
-    cur.close()
-    con.close()
-    return True
-
 ########################################################################################################################
 ### fixup_date
 ########################################################################################################################
@@ -797,1102 +1047,1457 @@ def change_date (dt: str) -> str:
     return str(d)
 
 ########################################################################################################################
-### do_create_date
+### check_datetime
 ########################################################################################################################
-def do_create_date (fn: str, id: str, dt: str) -> bool:
-    """Change the create date of an item."""
-    # Open journal file
-    try:
-        con = sql.connect (fn)
-        cur = con.cursor()
-    except sql.Error as em:
-        print ("*** SQLite error opening Journal file: {}".format (em))
-        return False
-
-    # Verify it is a sqlite journal file.
-    try:
-        cur.execute('SELECT * FROM item WHERE item_type = "NONE"')
-    except sql.Error as em:
-        print ("***Error: {} '{}'".format(args.filename, em))
-        cur.close()
-        con.close()
-        return False
-
-    # Good sqlite file. Proceed.
-    s = """BEGIN TRANSACTION; UPDATE item SET dtime = '{}' WHERE item_id = {}; COMMIT;""".format(dt, id)
-    try:
-        cur.executescript(s)
-    except sql.Error as em:
-        print ("*** Error: {} '{}'".format(s, em))
-        cur.close()
-        con.close()
-        return False
-    # Done
-    cur.close()
-    con.close()
-    return True
+def check_datetime (dt: str) -> str:
+    """Check a 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS' date given on the command-line and return it in full."""
+    for f in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return str(datetime.datetime.strptime (dt, f))
+        except ValueError:
+            pass
+    print ("*** Error: Date {} must be provided in 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS' format".format (dt))
+    sys.exit(3)
+
+########################################################################################################################
+### date_window
+########################################################################################################################
+def date_window (since: str, until: str, on: str = None) -> tuple:
+    """Turn --since/--until/--on into a (lo, hi) range of dtime values, lo <= dtime < hi. Either end may be None.
+
+    A bare date given to --until takes in the whole of that day. --on DATE is the same as --since DATE --until DATE.
+    """
+    lo = None
+    hi = None
+    if on:
+        if since or until:
+            print ("*** Error: --on cannot be combined with --since or --until")
+            sys.exit(3)
+        if len(on.strip()) != 10:
+            print ("*** Error: Date {} must be provided in 'YYYY-MM-DD' format".format (on))
+            sys.exit(3)
+        since = on
+        until = on
+    if since:
+        lo = check_datetime (since)
+    if until:
+        hi = check_datetime (until)
+        if len(until.strip()) == 10:
+            hi = str(datetime.datetime.strptime (hi, '%Y-%m-%d %H:%M:%S') + datetime.timedelta (days=1))
+        else:
+            hi = str(datetime.datetime.strptime (hi, '%Y-%m-%d %H:%M:%S') + datetime.timedelta (seconds=1))
+    return (lo, hi)
 
 ########################################################################################################################
-### createJournalFile
+### import_records
 ########################################################################################################################
-def createJournalFile (fn: str) -> bool:
-    """Create a journal file given by filename 'fn'."""
-    mycon = any
-    mycur = any
-    if os.path.isfile (fn):
-        print ("Journal file {} already exists - nothing created.".format (fn))
-        return True
-    try:
-        mycon = sql.connect (fn)
-        mycur = mycon.cursor()
-        mycur.executescript (SQLInitialize)
-    except sql.Error as em:
-        print ("*** SQLite error creating Journal file: {}".format (em))
-        return False
-    mycur.close()
-    mycon.close()
-    return True
+def import_records (f, fmt: str):
+    """Yield (line number, record) from a JSONL or CSV stream. CSV records are dicts keyed by the header row; JSONL
+    records are the raw lines, decoded one at a time so a bad line only costs that record."""
+    if fmt == 'csv':
+        rdr = csv.DictReader (f)
+        for r in rdr:
+            yield rdr.line_num, r
+        return
+    for n, line in enumerate (f, 1):
+        if line.strip():
+            yield n, line
 
 ########################################################################################################################
-### do_log
+### quiet_broken_pipe
 ########################################################################################################################
-def do_log (fn: str, log: str) -> bool:
-    # Open journal file
-    try:
-        con = sql.connect (fn)
-        cur = con.cursor()
-    except sql.Error as em:
-        print ("*** SQLite error opening Journal file: {}".format (em))
-        return False
-
-    # Verify it is a sqlite journal file.
-    try:
-        cur.execute('SELECT * FROM item WHERE item_type = "NONE"')
-    except sql.Error as em:
-        print ("***Error: {} '{}'".format(args.filename, em))
-        cur.close()
-        con.close()
-        return False
-    # Good sqlite file. Proceed.
-
-    # Build the INSERT
-    s = """BEGIN TRANSACTION; INSERT INTO item VALUES (NULL, 'LOG', datetime('now','localtime'), NULL, False, False,'{}'); COMMIT;""".format(log)
-    try:
-        cur.executescript(s)
-    except sql.Error as em:
-        print ("*** Error: {} '{}'".format(s, em))
-        cur.close()
-        con.close()
-        return False
-    # Return the item_id of the item just entered
-    try:
-        cur.execute("SELECT MAX(item_id) FROM item;")
-    except sql.Error as em:
-        print ("***Error: {} '{}'".format(fn, em))
-        cur.close()
-        con.close()
-        return False
-    row = cur.fetchone()
-    if row and row[0]:
-        cur.close()
-        con.close()
-        return row[0]
-    else:
-        cur.close()
-        con.close()
-        return False
+def quiet_broken_pipe () -> None:
+    """The reader of stdout went away (jnl ... | head). Point stdout at devnull so exit doesn't complain again."""
+    devnull = os.open (os.devnull, os.O_WRONLY)
+    os.dup2 (devnull, sys.stdout.fileno ())
 
 ########################################################################################################################
-### do_note
+### fmt_ts
 ########################################################################################################################
-def do_note (fn: str, note: str) -> bool:
-    # Open journal file
-    try:
-        con = sql.connect (fn)
-        cur = con.cursor()
-    except sql.Error as em:
-        print ("*** SQLite error opening Journal file: {}".format (em))
-        return False
-
-    # Verify it is a sqlite journal file.
-    try:
-        cur.execute('SELECT * FROM item WHERE item_type = "NONE"')
-    except sql.Error as em:
-        print ("***Error: {} '{}'".format(args.filename, em))
-        cur.close()
-        con.close()
-        return False
-    # Good sqlite file. Proceed.
-
-    # Build the INSERT
-    s = """BEGIN TRANSACTION; INSERT INTO item VALUES (NULL, 'NOTE', datetime('now','localtime'), NULL, False, False,'{}'); COMMIT;""".format(note)
-    try:
-        cur.executescript(s)
-    except sql.Error as em:
-        print ("*** Error: {} '{}'".format(s, em))
-        cur.close()
-        con.close()
-        return False
-    # Return the item_id of the item just entered
-    try:
-        cur.execute("SELECT MAX(item_id) FROM item;")
-    except sql.Error as em:
-        print ("***Error: {} '{}'".format(fn, em))
-        cur.close()
-        con.close()
-        return False
-    row = cur.fetchone()
-    if row and row[0]:
-        cur.close()
-        con.close()
-        return row[0]
-    else:
-        cur.close()
-        con.close()
-        return False
+def fmt_ts (v) -> str:
+    """Render a stored timestamp for output. Epoch journals hold UTC seconds, which are shown in local time."""
+    if isinstance (v, int):
+        return time.strftime ('%Y-%m-%d %H:%M:%S', time.localtime (v))
+    return str(v)
 
 ########################################################################################################################
-### do_idea
+### page_text
 ########################################################################################################################
-def do_idea (fn: str, idea: str) -> bool:
-    # Open journal file
-    try:
-        con = sql.connect (fn)
-        cur = con.cursor()
-    except sql.Error as em:
-        print ("*** SQLite error opening Journal file: {}".format (em))
-        return False
-
-    # Verify it is a sqlite journal file.
-    try:
-        cur.execute('SELECT * FROM item WHERE item_type = "NONE"')
-    except sql.Error as em:
-        print ("***Error: {} '{}'".format(args.filename, em))
-        cur.close()
-        con.close()
-        return False
-    # Good sqlite file. Proceed.
-
-    # Build the INSERT
-    s = """BEGIN TRANSACTION; INSERT INTO item VALUES (NULL, 'IDEA', datetime('now','localtime'), NULL, False, False,'{}'); COMMIT;""".format(idea)
-    try:
-        cur.executescript(s)
-    except sql.Error as em:
-        print ("*** Error: {} '{}'".format(s, em))
-        cur.close()
-        con.close()
-        return False
-    # Return the item_id of the item just entered
-    try:
-        cur.execute("SELECT MAX(item_id) FROM item;")
-    except sql.Error as em:
-        print ("***Error: {} '{}'".format(fn, em))
-        cur.close()
-        con.close()
-        return False
-    row = cur.fetchone()
-    if row and row[0]:
-        cur.close()
-        con.close()
-        return row[0]
-    else:
-        cur.close()
-        con.close()
-        return False
+def page_text (v) -> str:
+    """A stored page as text. Pages streamed in by --pg are BLOBs holding the file's bytes, normally UTF-8."""
+    if isinstance (v, bytes):
+        return v.decode ('utf-8', 'replace')
+    return v
 
 ########################################################################################################################
-### do_quot
+### pg_text
 ########################################################################################################################
-def do_quot (fn: str, quot: str) -> bool:
-    # Open journal file
-    try:
-        con = sql.connect (fn)
-        cur = con.cursor()
-    except sql.Error as em:
-        print ("*** SQLite error opening Journal file: {}".format (em))
-        return False
-
-    # Verify it is a sqlite journal file.
-    try:
-        cur.execute('SELECT * FROM item WHERE item_type = "NONE"')
-    except sql.Error as em:
-        print ("***Error: {} '{}'".format(args.filename, em))
-        cur.close()
-        con.close()
-        return False
-    # Good sqlite file. Proceed.
-
-    # Build the INSERT
-    s = """BEGIN TRANSACTION; INSERT INTO item VALUES (NULL, 'QUOT', datetime('now','localtime'), NULL, False, False,'{}'); COMMIT;""".format(quot)
-    try:
-        cur.executescript(s)
-    except sql.Error as em:
-        print ("*** Error: {} '{}'".format(s, em))
-        cur.close()
-        con.close()
-        return False
-    # Return the item_id of the item just entered
-    try:
-        cur.execute("SELECT MAX(item_id) FROM item;")
-    except sql.Error as em:
-        print ("***Error: {} '{}'".format(fn, em))
-        cur.close()
-        con.close()
-        return False
-    row = cur.fetchone()
-    if row and row[0]:
-        cur.close()
-        con.close()
-        return row[0]
-    else:
-        cur.close()
-        con.close()
-        return False
+def pg_text (data, codec):
+    """SQL function pg_text(data, codec): the bytes of a compressed page, decompressed."""
+    if data is None or codec is None:
+        return data
+    d = PAGE_CODECS[codec][1] ()
+    out = d.decompress (data)
+    if hasattr (d, 'flush'):
+        out += d.flush ()
+    return out
 
 ########################################################################################################################
-### do_todo
+### page_delta
 ########################################################################################################################
-def do_todo (fn: str, td: str) -> bool:
-    # Open journal file
-    try:
-        con = sql.connect (fn)
-        cur = con.cursor()
-    except sql.Error as em:
-        print ("*** SQLite error opening Journal file: {}".format (em))
-        return False
-
-    # Verify it is a sqlite journal file.
-    try:
-        cur.execute('SELECT * FROM item WHERE item_type = "NONE"')
-    except sql.Error as em:
-        print ("***Error: {} '{}'".format(args.filename, em))
-        cur.close()
-        con.close()
-        return False
-    # Good sqlite file. Proceed.
-
-    # Build the INSERT
-    s = """BEGIN TRANSACTION; INSERT INTO item VALUES (NULL, 'TODO', datetime('now','localtime'), NULL, False, False,'{}'); COMMIT;""".format(td)
-    try:
-        cur.executescript(s)
-    except sql.Error as em:
-        print ("*** Error: {} '{}'".format(s, em))
-        cur.close()
-        con.close()
-        return False
-    # Return the item_id of the item just entered
-    try:
-        cur.execute("SELECT MAX(item_id) FROM item;")
-    except sql.Error as em:
-        print ("***Error: {} '{}'".format(fn, em))
-        cur.close()
-        con.close()
-        return False
-    row = cur.fetchone()
-    if row and row[0]:
-        cur.close()
-        con.close()
-        return row[0]
-    else:
-        cur.close()
-        con.close()
-        return False
+def page_delta (new: str, old: str) -> str:
+    """The reverse line delta that turns page text new back into old, as JSON: a list of [i, j, lines], each one
+    replacing lines i:j of new with lines."""
+    a = new.splitlines (keepends=True)
+    b = old.splitlines (keepends=True)
+    ops = [[i1, i2, b[j1:j2]] for tag, i1, i2, j1, j2 in difflib.SequenceMatcher (None, a, b).get_opcodes ()
+           if tag != 'equal']
+    return json.dumps (ops, separators=(',', ':'))
 
 ########################################################################################################################
-### do_edit
+### apply_delta
 ########################################################################################################################
-def do_edit (fn: str, id: str, itm: str) -> bool:
-    # Open journal file
-    try:
-        con = sql.connect (fn)
-        cur = con.cursor()
-    except sql.Error as em:
-        print ("*** SQLite error opening Journal file: {}".format (em))
-        return False
-
-    # Verify it is a sqlite journal file.
-    try:
-        cur.execute('SELECT * FROM item WHERE item_type = "NONE"')
-    except sql.Error as em:
-        print ("***Error: {} '{}'".format(args.filename, em))
-        cur.close()
-        con.close()
-        return False
-    # Good sqlite file. Proceed.
-
-    # Build the INSERT
-    s = """BEGIN TRANSACTION; UPDATE item SET item = '{}',updt = datetime('now','localtime') WHERE item_id = {}; COMMIT;""".format(itm, id)
-    try:
-        cur.executescript(s)
-    except sql.Error as em:
-        print ("*** Error: {} '{}'".format(s, em))
-        cur.close()
-        con.close()
-        return False
-    cur.close()
-    con.close()
-    return True
+def apply_delta (new: str, delta: str) -> str:
+    """Apply a page_delta to new, giving back the older text."""
+    a = new.splitlines (keepends=True)
+    out = []
+    i = 0
+    for i1, i2, lines in json.loads (delta):
+        out += a[i:i1]
+        out += lines
+        i = i2
+    out += a[i:]
+    return ''.join (out)
 
 ########################################################################################################################
-### do_recent
+### fmt_item
 ########################################################################################################################
-def do_recent (fn: str) -> bool:
-    '''Print num items to the screen, sorted by todo,  others.'''
-    # Number of items to sort. Change this if you want more or fewer.
-    num = 5
-    # Open journal file
-    try:
-        con = sql.connect (fn)
-        cur = con.cursor()
-    except sql.Error as em:
-        print ("*** SQLite error opening Journal file: {}".format (em))
-        return False
-
-    # Verify it is a sqlite journal file.
-    try:
-        cur.execute('SELECT * FROM item WHERE item_type = "NONE"')
-    except sql.Error as em:
-        print ("***Error: {} '{}'".format(args.filename, em))
-        cur.close()
-        con.close()
-        return False
-    # Good sqlite file. Proceed.
-
-    # Build the SELECT
-    s = """SELECT * FROM item WHERE item_type IS NOT 'NONE' and item_type IS NOT 'TODO' ORDER BY dtime;"""
-    try:
-        cur.execute(s)
-    except sql.Error as em:
-        print ("*** Error: {} '{}'".format(s, em))
-        cur.close()
-        con.close()
-        return False
-    ls_dat = []
-    rows = cur.fetchall()
-    # 0 = item_id, 1 = item_type, 2 = dtime, 3 = updt, 4 = is_pg, 5 = is_done, 6 = item
-    s = '{}: {}: {}: {}: {}: {}'.format(' ** TYPE ** ', ' ** PAGE ** ',' ** ITEM_ID ** ', ' ** CREATED ** ', ' ** UPDATED ** ',' ** ITEM ** ')
-    print (s)
-    print ("\n*** Logs, ideas, quotes, notes ***\n")
-    for r in rows:
-        bullet = dot
-        if r[1] == 'LOG':
-            bullet = dot
-        if r[1] == 'NOTE':
-            bullet = note
-        if r[1] == 'IDEA':
-            bullet = idea
-        if r[1] == 'QUOT':
-            bullet = quot
-        pg = str
-        if r[4] == 0:
-            pg = non
-        else:
-            pg = page
-        s = '{0} : {1} : {2:>5d}: {3:<19s}: {4:<19s} | {5}'.format (bullet, pg, r[0], str(r[2]), str(r[3]), r[6])
-        ls_dat.append (s)
-    n = len(ls_dat)
-    if n == 0:
-        print (" *** No items to output *** ")
-    elif n < num:
-        for s in ls_dat:
-            print (s)
-    else:
-        for s in ls_dat[-num:]:
-            print (s)
-    # Next, grab completed todos and print them.
-    s = """SELECT * FROM item WHERE item_type IS 'TODO' AND is_done IS 1 ORDER BY item_id"""
-    try:
-        cur.execute(s)
-    except sql.Error as em:
-        print ("*** Error: {} '{}'".format(s, em))
-        cur.close()
-        con.close()
-        return False
-    ls_dat = []
-    rows = cur.fetchall()
-    # 0 = item_id, 1 = item_type, 2 = dtime, 3 = updt, 4 = is_pg, 5 = is_done, 6 = item
-    print ("\n*** Completed todos ***\n")
-    bullet = done
-    for r in rows:
-        pg = str
-        if r[4] == 0:
-            pg = non
-        else:
-            pg = page
-        s = '{0} : {1} : {2:>5d}: {3:<19s}: {4:<19s} | {5}'.format (bullet, pg, r[0], str(r[2]), str(r[3]), r[6])
-        ls_dat.append (s)
-    n = len(ls_dat)
-    if len(ls_dat) == 0:
-        print (" *** No completed todo items *** \n")
-    elif n < num:
-        for s in ls_dat:
-            print (s)
-    else:
-        for s in ls_dat[-num:]:
-            print (s)
-    # Next, grab current todos and print them.
-    s = """SELECT * FROM item WHERE item_type IS 'TODO' and is_done IS 0 ORDER BY item_id;"""
-    try:
-        cur.execute(s)
-    except sql.Error as em:
-        print ("*** Error: {} '{}'".format(s, em))
-        cur.close()
-        con.close()
-        return False
-    ls_dat = []
-    rows = cur.fetchall()
+def fmt_item (r: tuple) -> str:
+    """Format one item row for output. The row starts with the item table columns, in table order."""
     # 0 = item_id, 1 = item_type, 2 = dtime, 3 = updt, 4 = is_pg, 5 = is_done, 6 = item
-    print ("\n*** Open todos ***\n")
-    bullet = todo
-    for r in rows:
-        pg = str
-        if r[4] == 0:
-            pg = non
-        else:
-            pg = page
-        s = '{0} : {1} : {2:>5d}: {3:<19s}: {4:<19s} | {5}'.format (bullet, pg, r[0], str(r[2]), str(r[3]), r[6])
-        ls_dat.append (s)
-    n = len(ls_dat)
-    if n == 0:
-        print (" *** No open todo items *** \n")
-    elif n < num:
-        for s in ls_dat:
-            print (s)
+    bullet = bullets.get (r[1], dot)
+    if r[5] == 1:
+        bullet = done
+    if r[4]:
+        pg = page
     else:
-        for s in ls_dat[-num:]:
-            print (s)
-    # Done
-    cur.close()
-    con.close()
-    return True
+        pg = non
+    return '{0} : {1} : {2:>5d}: {3:<19s}: {4:<19s} | {5}'.format (bullet, pg, r[0], fmt_ts(r[2]), fmt_ts(r[3]), r[6])
 
 ########################################################################################################################
-### do_ls
+### script_statements
 ########################################################################################################################
-def do_ls (fn: str) -> bool:
-    '''Print all items to the screen, sorted by todo, completed todo and others.'''
-    # Open journal file
-    try:
-        con = sql.connect (fn)
-        cur = con.cursor()
-    except sql.Error as em:
-        print ("*** SQLite error opening Journal file: {}".format (em))
-        return False
+def script_statements (script: str) -> list:
+    """Split a migration script into its statements. A ';' inside a trigger body or a string does not end one."""
+    out = []
+    s = ''
+    for part in script.split (';'):
+        s += part + ';'
+        if sql.complete_statement (s):
+            if s.strip (' \t\n;'):
+                out.append (s)
+            s = ''
+    return out
 
-    # Verify it is a sqlite journal file.
-    try:
-        cur.execute('SELECT * FROM item WHERE item_type = "NONE"')
-    except sql.Error as em:
-        print ("***Error: {} '{}'".format(args.filename, em))
-        cur.close()
-        con.close()
-        return False
-    # Good sqlite file. Proceed.
-
-    # Build the SELECT
-    s = """SELECT * FROM item WHERE item_type IS NOT 'NONE' and item_type IS NOT 'TODO' ORDER BY dtime;"""
-    try:
-        cur.execute(s)
-    except sql.Error as em:
-        print ("*** Error: {} '{}'".format(s, em))
-        cur.close()
-        con.close()
-        return False
-    ls_dat = []
-    rows = cur.fetchall()
-    # 0 = item_id, 1 = item_type, 2 = dtime, 3 = updt, 4 = is_pg, 5 = is_done, 6 = item
-    s = '{}: {}: {}: {}: {}: {}'.format(' ** TYPE ** ', ' ** PAGE ** ',' ** ITEM_ID ** ', ' ** CREATED ** ', ' ** UPDATED ** ',' ** ITEM ** ')
-    print (s)
-    print ("\n*** Logs, ideas, quotes, notes ***\n")
-    for r in rows:
-        bullet = dot
-        if r[1] == 'LOG':
-            bullet = dot
-        if r[1] == 'NOTE':
-            bullet = note
-        if r[1] == 'IDEA':
-            bullet = idea
-        if r[1] == 'QUOT':
-            bullet = quot
-        pg = str
-        if r[4] == 0:
-            pg = non
-        else:
-            pg = page
-        s = '{0} : {1} : {2:>5d}: {3:<19s}: {4:<19s} | {5}'.format (bullet, pg, r[0], str(r[2]), str(r[3]), r[6])
-        ls_dat.append (s)
-    if len(ls_dat) == 0:
-        print (" *** No items to output *** ")
-    else:
-        for s in ls_dat:
-            print (s)
-    # Next, grab completed todos and print them.
-    s = """SELECT * FROM item WHERE item_type IS 'TODO' AND is_done IS 1 ORDER BY item_id"""
-    try:
-        cur.execute(s)
-    except sql.Error as em:
-        print ("*** Error: {} '{}'".format(s, em))
-        cur.close()
-        con.close()
-        return False
-    ls_dat = []
-    rows = cur.fetchall()
-    # 0 = item_id, 1 = item_type, 2 = dtime, 3 = updt, 4 = is_pg, 5 = is_done, 6 = item
-    print ("\n*** Completed todos ***\n")
-    bullet = done
-    for r in rows:
-        pg = str
-        if r[4] == 0:
-            pg = non
-        else:
-            pg = page
-        s = '{0} : {1} : {2:>5d}: {3:<19s}: {4:<19s} | {5}'.format (bullet, pg, r[0], str(r[2]), str(r[3]), r[6])
-        ls_dat.append (s)
-    if len(ls_dat) == 0:
-        print (" *** No completed todo items *** \n")
-    else:
-        for s in ls_dat:
-            print (s)
-    # Next, grab current todos and print them.
-    s = """SELECT * FROM item WHERE item_type IS 'TODO' and is_done IS 0 ORDER BY item_id;"""
-    try:
-        cur.execute(s)
-    except sql.Error as em:
-        print ("*** Error: {} '{}'".format(s, em))
-        cur.close()
-        con.close()
-        return False
-    ls_dat = []
-    rows = cur.fetchall()
-    # 0 = item_id, 1 = item_type, 2 = dtime, 3 = updt, 4 = is_pg, 5 = is_done, 6 = item
-    print ("\n*** Open todos ***\n")
-    bullet = todo
-    for r in rows:
-        pg = str
-        if r[4] == 0:
-            pg = non
-        else:
-            pg = page
-        s = '{0} : {1} : {2:>5d}: {3:<19s}: {4:<19s} | {5}'.format (bullet, pg, r[0], str(r[2]), str(r[3]), r[6])
-        ls_dat.append (s)
-    if len(ls_dat) == 0:
-        print (" *** No open todo items *** \n")
-    else:
-        for s in ls_dat:
-            print (s)
-    # Done
-    cur.close()
-    con.close()
-    return True
+########################################################################################################################
+### stamp_journal_header
+########################################################################################################################
+def stamp_journal_header (cur: sql.Cursor) -> None:
+    """Write the jnl application_id and base schema version into the database header."""
+    cur.execute ('PRAGMA application_id = {}'.format (JNL_APPLICATION_ID))
+    cur.execute ('PRAGMA user_version = {}'.format (JNL_BASE_VERSION))
 
 ########################################################################################################################
-### do_ls_all
+### createJournalFile
 ########################################################################################################################
-def do_ls_all (fn: str) -> bool:
-    '''Print all the items without sorting by todo and non-todo, only by date. Works only with --ls.'''
-    # Open journal file
+def createJournalFile (fn: str) -> bool:
+    """Create a journal file given by filename 'fn'."""
+    mycon = any
+    mycur = any
+    if os.path.isfile (fn):
+        print ("Journal file {} already exists - nothing created.".format (fn))
+        return True
     try:
-        con = sql.connect (fn)
-        cur = con.cursor()
+        mycon = sql.connect (fn)
+        mycur = mycon.cursor()
+        mycur.executescript (SQLInitialize)
+        stamp_journal_header (mycur)
+        mycur.execute ('PRAGMA journal_mode = WAL')
     except sql.Error as em:
-        print ("*** SQLite error opening Journal file: {}".format (em))
+        print ("*** SQLite error creating Journal file: {}".format (em))
         return False
+    mycur.close()
+    mycon.close()
+    return True
 
-    # Verify it is a sqlite journal file.
-    try:
-        cur.execute('SELECT * FROM item WHERE item_type = "NONE"')
-    except sql.Error as em:
-        print ("***Error: {} '{}'".format(args.filename, em))
-        cur.close()
-        con.close()
-        return False
-    # Good sqlite file. Proceed.
+########################################################################################################################
+### Journal
+########################################################################################################################
+class Journal:
+    """An open journal file. One connection and one cursor are shared by every command for the life of the process."""
+
+    def __init__ (self, fn: str, busy_timeout: int = BUSY_TIMEOUT, synchronous: str = None):
+        self.fn = fn
+        # Milliseconds to wait for another writer's lock.
+        self.busy_timeout = busy_timeout
+        # PRAGMA synchronous for this connection, or None for SQLite's default (FULL).
+        self.synchronous = synchronous
+        self.con = None
+        self.cur = None
+        # Schema version of the open journal file (PRAGMA user_version).
+        self.version = 0
+        # True when timestamps are stored as integer UTC epoch seconds instead of local 'YYYY-MM-DD HH:MM:SS' text.
+        self.epoch = False
+        # True while commands run inside a transaction the caller owns (run_in_transaction, --batch, --replay). The
+        # do_* write methods never begin or commit themselves.
+        self.batch = False
+        # True when the journal has the item_fts --search index.
+        self.fts = False
+        # When set, the time used in place of now (in the journal's timestamp format). --replay sets it to the time
+        # each command was first run.
+        self.clock = None
+
+    ####################################################################################################################
+    ### open
+    ####################################################################################################################
+    def open (self) -> bool:
+        """Open the journal file, set up the connection and verify it is a journal."""
+        # Open journal file
+        try:
+            # Autocommit mode: transactions are begun and committed explicitly, never implicitly by the sqlite3 module.
+            self.con = sql.connect (self.fn, timeout=self.busy_timeout / 1000, isolation_level=None)
+            self.cur = self.con.cursor()
+        except sql.Error as em:
+            print ("*** SQLite error opening Journal file: {}".format (em))
+            return False
 
-    # Build the SELECT
-    s = """SELECT * FROM item WHERE item_type IS NOT 'NONE' ORDER BY dtime;"""
-    try:
-        cur.execute(s)
-    except sql.Error as em:
-        print ("*** Error: {} '{}'".format(s, em))
-        cur.close()
-        con.close()
-        return False
-    ls_dat = []
-    rows = cur.fetchall()
-    # 0 = item_id, 1 = item_type, 2 = dtime, 3 = updt, 4 = is_pg, 5 = is_done, 6 = item
-    s = '{}: {}: {}: {}: {}: {}'.format(' ** TYPE ** ', ' ** PAGE ** ',' ** ITEM_ID ** ', ' ** CREATED ** ', ' ** UPDATED ** ',' ** ITEM ** ')
-    print (s)
-    print ("\n*** Logs, ideas, quotes, notes ***\n")
-    for r in rows:
-        bullet = dot
-        if r[1] == 'LOG':
-            bullet = dot
-        if r[1] == 'NOTE':
-            bullet = note
-        if r[1] == 'IDEA':
-            bullet = idea
-        if r[1] == 'QUOT':
-            bullet = quot
-        if r[1] == 'TODO':
-            bullet = todo
-        pg = str
-        if r[4] == 0:
-            pg = non
-        else:
-            pg = page
-        s = '{0} : {1} : {2:>5d}: {3:<19s}: {4:<19s} | {5}'.format (bullet, pg, r[0], str(r[2]), str(r[3]), r[6])
-        ls_dat.append (s)
-    if len(ls_dat) == 0:
-        print (" *** No items to output *** ")
-    else:
-        for s in ls_dat:
-            print (s)
-    # Done
-    cur.close()
-    con.close()
-    return True
-
-########################################################################################################################
-### do_rm
-########################################################################################################################
-def do_rm (fn: str, id: str) -> bool:
-    # Open journal file
-    try:
-        con = sql.connect (fn)
-        cur = con.cursor()
-    except sql.Error as em:
-        print ("*** SQLite error opening Journal file: {}".format (em))
-        return False
+        # Connection setup. Done once here instead of in every command.
+        try:
+            self.cur.execute ('PRAGMA temp_store = MEMORY')
+            self.cur.execute ('PRAGMA cache_size = -8000')
+            self.con.create_function ('pg_text', 2, pg_text, deterministic=True)
+            if self.synchronous:
+                # NORMAL skips the fsync at each commit in WAL mode. A power cut can lose the last commits, never
+                # the journal.
+                self.cur.execute ('PRAGMA synchronous = {}'.format (self.synchronous))
+        except sql.Error as em:
+            print ("***Error: {} '{}'".format(self.fn, em))
+            self.close()
+            return False
 
-    # Verify it is a sqlite journal file.
-    try:
-        cur.execute('SELECT * FROM item WHERE item_type = "NONE"')
-    except sql.Error as em:
-        print ("***Error: {} '{}'".format(args.filename, em))
-        cur.close()
-        con.close()
-        return False
-    # Good sqlite file. Proceed.
+        # Verify it is a sqlite journal file.
+        if not self.verify():
+            self.close()
+            return False
+        # Good sqlite file. Bring the schema up to date and proceed.
+        if self.version < JNL_USER_VERSION and not self.migrate():
+            self.close()
+            return False
+        # The timestamp format is whatever the item.dtime column was declared as.
+        try:
+            self.cur.execute ("SELECT type FROM pragma_table_info('item') WHERE name = 'dtime'")
+            r = self.cur.fetchone()
+        except sql.Error as em:
+            print ("***Error: {} '{}'".format(self.fn, em))
+            self.close()
+            return False
+        self.epoch = bool (r and r[0].upper() == 'INTEGER')
+        try:
+            self.cur.execute ("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'item_fts'")
+            self.fts = bool (self.cur.fetchall())
+        except sql.Error as em:
+            print ("***Error: {} '{}'".format(self.fn, em))
+            self.close()
+            return False
+        return True
 
-    # Build the INSERT
-    s = """SELECT item_type,dtime,updt,is_pg,item FROM item WHERE item_id = {}""".format(id)
-    try:
-        cur.execute(s)
-    except sql.Error as em:
-        print ("*** Error: {} '{}'".format(s, em))
-        cur.close()
-        con.close()
-        return False
-    r = cur.fetchone()
-    # 0 = item_id, 1 = item_type, 2 = dtime, 3 = updt, 4 = is_pg, 5 = is_done, 6 = item
-    pg = str
-    if not r:
-        return False
-    item_type = r[0]
-    dtime = r[1]
-    if dtime == None:
-        dtime = 'NULL'
-    updt = r[2]
-    if updt == None:
-        updt = 'NULL'
-    is_pg = r[3]
-    item = r[4]
-    s = """BEGIN TRANSACTION; INSERT INTO archive VALUES({},'{}','{}','{}','{}','{}','NULL'); COMMIT;""".format (id,item_type,dtime,updt,is_pg,item)
-    try:
-        cur.executescript(s)
-    except sql.Error as em:
-        print ("*** Error: {} '{}'".format(s, em))
-        cur.close()
-        con.close()
-        return False
-    if is_pg:
-        s = """SELECT data FROM page WHERE item_id IS {}""".format(id)
+    ####################################################################################################################
+    ### ts_value
+    ####################################################################################################################
+    def ts_value (self, dt: str = None):
+        """Value to store for a local 'YYYY-MM-DD HH:MM:SS' time (now if dt is None) in the journal's timestamp format."""
+        if dt is None and self.clock is not None:
+            return self.clock
+        if self.epoch:
+            if dt is None:
+                return int(time.time())
+            return int(datetime.datetime.fromisoformat (dt).timestamp())
+        if dt is None:
+            return time.strftime ('%Y-%m-%d %H:%M:%S')
+        return dt
+
+    ####################################################################################################################
+    ### window_sql
+    ####################################################################################################################
+    def window_sql (self, window: tuple, col: str = 'dtime') -> tuple:
+        """Return the ' AND ...' terms that keep col inside a date_window range, and the values they bind. Empty if
+        the range is open."""
+        s = ""
+        params = []
+        if window[0]:
+            s += " AND {} >= ?".format (col)
+            params.append (self.ts_value (window[0]))
+        if window[1]:
+            s += " AND {} < ?".format (col)
+            params.append (self.ts_value (window[1]))
+        return s, params
+
+    ####################################################################################################################
+    ### verify
+    ####################################################################################################################
+    def verify (self) -> bool:
+        """Verify the file is a journal by reading application_id and user_version from the database header."""
         try:
-            cur.execute(s)
+            self.cur.execute ('PRAGMA application_id')
+            app_id = self.cur.fetchone()[0]
+            self.cur.execute ('PRAGMA user_version')
+            version = self.cur.fetchone()[0]
         except sql.Error as em:
-            print ("*** Error: {} '{}'".format(s, em))
-            cur.close()
-            con.close()
-            return False
-        row = cur.fetchone()
-        if row and row[0]:
-            pg_data = row[0]
-        pg_data = pg_data.replace("'","''")
-        s = """BEGIN TRANSACTION; UPDATE archive SET pg_data = '{}' WHERE item_id = {}; COMMIT;""".format (pg_data,id)
+            print ("***Error: {} '{}'".format(self.fn, em))
+            return False
+        if app_id == JNL_APPLICATION_ID:
+            if version > JNL_USER_VERSION:
+                print ("***Error: {} was written by a newer jnl (version {})".format(self.fn, version))
+                return False
+            self.version = version
+            return True
+        if app_id != 0:
+            print ("***Error: {} is not a journal file".format(self.fn))
+            return False
+        # No application_id, so this is either a journal from before the header was stamped or some other sqlite
+        # file. Check for the journal tables once and stamp the header so this is never done again.
+        return self.upgrade_header()
+
+    ####################################################################################################################
+    ### upgrade_header
+    ####################################################################################################################
+    def upgrade_header (self) -> bool:
+        """One-time upgrade of a journal created before application_id/user_version were stamped."""
+        s = """SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name IN ('item','page','cmd_line','archive')"""
         try:
-            cur.executescript(s)
+            self.cur.execute(s)
         except sql.Error as em:
             print ("*** Error: {} '{}'".format(s, em))
-            cur.close()
-            con.close()
             return False
-    s = """BEGIN TRANSACTION; DELETE FROM item WHERE item_id = {}; COMMIT;""".format(id)
-    try:
-        cur.executescript(s)
-    except sql.Error as em:
-        print ("*** Error: {} '{}'".format(s, em))
-        cur.close()
-        con.close()
-        return False
-    cur.close()
-    con.close()
-    return True
-
-########################################################################################################################
-### do_pg
-########################################################################################################################
-def do_pg (fn: str, id: str, file: str) -> bool:
-    """Associate a page of data to an item."""
-    # Open journal file
-    try:
-        con = sql.connect (fn)
-        cur = con.cursor()
-    except sql.Error as em:
-        print ("*** SQLite error opening Journal file: {}".format (em))
-        return False
-
-    # Verify it is a sqlite journal file.
-    try:
-        cur.execute('SELECT * FROM item WHERE item_type = "NONE"')
-    except sql.Error as em:
-        print ("***Error: {} '{}'".format(args.filename, em))
-        cur.close()
-        con.close()
-        return False
-
-    # Good sqlite file. Proceed.
-
-    # Open the file to add as a page
-    f = open(file, "r")
-    t = f.read()
-    if ('\'' in str(t)):
-        t = t.replace ("'","''")
-    s = '''BEGIN TRANSACTION; DELETE FROM page WHERE item_id = {}'''.format (id)
-    try:
-        cur.executescript(s)
-    except sql.Error as em:
-        print ("*** Error: {} '{}'".format(s, em))
-        cur.close()
-        con.close()
-        return False
-    s = """BEGIN TRANSACTION; INSERT INTO page VALUES ({},datetime('now','localtime'),NULL, '{}'); COMMIT;""".format (id, t)
-    try:
-        cur.executescript(s)
-    except sql.Error as em:
-        print ("*** Error: {} '{}'".format(s, em))
-        cur.close()
-        con.close()
-        return False
-    s = """BEGIN TRANSACTION; UPDATE item SET updt = datetime('now','localtime'), is_pg = TRUE WHERE item_id = {}; COMMIT;""".format(id)
-    try:
-        cur.executescript(s)
-    except sql.Error as em:
-        print ("*** Error: {} '{}'".format(s, em))
-        cur.close()
-        con.close()
-        return False
-    # Done
-    cur.close()
-    con.close()
-    return True
+        row = self.cur.fetchone()
+        if not row or row[0] != 4:
+            print ("***Error: {} is not a journal file".format(self.fn))
+            return False
+        # Another jnl process may be stamping, and even migrating, the same file. Check again under the write lock.
+        try:
+            self.begin ()
+            self.cur.execute ('PRAGMA application_id')
+            if self.cur.fetchone()[0] == JNL_APPLICATION_ID:
+                self.cur.execute ('PRAGMA user_version')
+                self.version = self.cur.fetchone()[0]
+            else:
+                stamp_journal_header (self.cur)
+                self.version = JNL_BASE_VERSION
+            self.con.commit()
+        except sql.Error as em:
+            print ("***Error: could not stamp journal header in {} '{}'".format(self.fn, em))
+            if self.con.in_transaction:
+                self.con.rollback()
+            return False
+        return True
 
-########################################################################################################################
-### do_show_pg
-########################################################################################################################
-def do_show_pg (fn: str, id: str) -> bool:
-    """Show the pg in fn given by id."""
-    # Open journal file
-    try:
-        con = sql.connect (fn)
-        cur = con.cursor()
-    except sql.Error as em:
-        print ("*** SQLite error opening Journal file: {}".format (em))
-        return False
+    ####################################################################################################################
+    ### migrate
+    ####################################################################################################################
+    def migrate (self) -> bool:
+        """Upgrade the journal file in place to JNL_USER_VERSION, one migration per transaction. Several jnl processes
+        can open the same old journal at once, so each step reads user_version again once it holds the write lock
+        and is skipped if another process got there first."""
+        if self.version < WAL_VERSION:
+            try:
+                self.retry (self.cur.execute, 'PRAGMA journal_mode = WAL')
+                self.cur.fetchall()
+            except sql.Error as em:
+                print ("*** Error: migrating {} to WAL journaling '{}'".format(self.fn, em))
+                return False
+        for version, desc, script in MIGRATIONS:
+            if version <= self.version:
+                continue
+            try:
+                self.begin ()
+                self.cur.execute ('PRAGMA user_version')
+                current = self.cur.fetchone()[0]
+                if current < version:
+                    if callable (script):
+                        script = script (self.cur)
+                    # One statement at a time: executescript would commit the transaction that holds the lock.
+                    for s in script_statements (script):
+                        self.cur.execute (s)
+                    self.cur.execute ('PRAGMA user_version = {}'.format (version))
+                self.con.commit()
+            except sql.Error as em:
+                print ("*** Error: migrating {} to version {} ({}) '{}'".format(self.fn, version, desc, em))
+                if self.con.in_transaction:
+                    self.con.rollback()
+                return False
+            self.version = max (version, current)
+        return True
 
-    # Verify it is a sqlite journal file.
-    try:
-        cur.execute('SELECT * FROM item WHERE item_type = "NONE"')
-    except sql.Error as em:
-        print ("***Error: {} '{}'".format(args.filename, em))
-        cur.close()
-        con.close()
-        return False
-    # Good sqlite file. Proceed.
+    ####################################################################################################################
+    ### close
+    ####################################################################################################################
+    def close (self) -> None:
+        """Close the cursor and connection to the journal file."""
+        if self.cur:
+            self.cur.close()
+            self.cur = None
+        if self.con:
+            self.con.close()
+            self.con = None
+
+    ####################################################################################################################
+    ### retry
+    ####################################################################################################################
+    def retry (self, run, *args):
+        """Call run(*args). If another process still holds the journal locked after busy_timeout, back off and try
+        again, up to WRITE_RETRIES times. Inside a caller's transaction the lock is already held, so no retry."""
+        for n in range (WRITE_RETRIES + 1):
+            try:
+                return run (*args)
+            except sql.OperationalError as em:
+                if self.batch or n == WRITE_RETRIES or em.sqlite_errorcode & 0xff not in (sql.SQLITE_BUSY, sql.SQLITE_LOCKED):
+                    raise
+                if self.con.in_transaction:
+                    self.con.rollback()
+                time.sleep (WRITE_BACKOFF * 2 ** n * random.uniform (0.5, 1.5))
+
+    ####################################################################################################################
+    ### begin
+    ####################################################################################################################
+    def begin (self) -> None:
+        """Start a write transaction, taking the write lock now rather than at the first write."""
+        self.retry (self.cur.execute, 'BEGIN IMMEDIATE TRANSACTION')
+
+    ####################################################################################################################
+    ### stamp_command
+    ####################################################################################################################
+    def stamp_command (self, cmd: str) -> bool:
+        """Stamp the command-line into the cmd_line table."""
+        return self.stamp_commands ([cmd])
+
+    ####################################################################################################################
+    ### stamp_commands
+    ####################################################################################################################
+    def stamp_commands (self, cmds: list) -> bool:
+        """Stamp several command-lines into the cmd_line table with one statement."""
+        now = self.ts_value ()
+        try:
+            if self.batch:
+                self.cur.executemany ("INSERT INTO cmd_line VALUES (?,?)", [(now, c) for c in cmds])
+            else:
+                self.retry (self.stamp_rows, [(now, c) for c in cmds])
+        except sql.Error as em:
+            print ("*** Error: {} '{}'".format(self.fn, em))
+            return False
+        # Done
+        return True
 
-    s = """SELECT * FROM item WHERE item_id IS {}""".format(id)
-    try:
-        cur.execute(s)
-    except sql.Error as em:
-        print ("*** Error: {} '{}'".format(s, em))
-        cur.close()
-        con.close()
-        return False
-    r = cur.fetchone()
-    # 0 = item_id, 1 = item_type, 2 = dtime, 3 = updt, 4 = is_pg, 5 = is_done, 6 = item
-    bullet = dot
-    pg = str
-    if not r:
-        return False
-    if r[1] == 'LOG':
-        bullet = dot
-    if r[1] == 'NOTE':
-        bullet = note
-    if r[1] == 'IDEA':
-        bullet = idea
-    if r[1] == 'QUOT':
-        bullet = quot
-    if r[1] == 'TODO':
-        bullet = todo
-    if r[5] == 1:
-        bullet = done
-    if r[4] and r[4] == 0:
-        pg = non
-    else:
-        pg = page
-    s = '{0} : {1} : {2:>5d}: {3:<19s}: {4:<19s} | {5}'.format (bullet, pg, r[0], str(r[2]), str(r[3]), r[6])
-    print (s)
+    ####################################################################################################################
+    ### stamp_rows
+    ####################################################################################################################
+    def stamp_rows (self, rows: list) -> None:
+        """Insert (dtime, cmd) rows into cmd_line in a transaction of their own."""
+        self.cur.execute ('BEGIN IMMEDIATE TRANSACTION')
+        self.cur.executemany ("INSERT INTO cmd_line VALUES (?,?)", rows)
+        self.con.commit()
+
+    ####################################################################################################################
+    ### do_create_date
+    ####################################################################################################################
+    def do_create_date (self, id: str, dt: str) -> bool:
+        """Change the create date of an item."""
+        s = """UPDATE item SET dtime = ? WHERE item_id = ?"""
+        try:
+            self.cur.execute(s, (self.ts_value (dt), id))
+        except sql.Error as em:
+            print ("*** Error: {} '{}'".format(s, em))
+            return False
+        if self.cur.rowcount != 1:
+            print ("*** Error: no item with item_id {}".format (id))
+            return False
+        # Done
+        return True
 
-    s = """SELECT data FROM page WHERE item_id IS {}""".format(id)
-    try:
-        cur.execute(s)
-    except sql.Error as em:
-        print ("*** Error: {} '{}'".format(s, em))
-        cur.close()
-        con.close()
-        return False
-    row = cur.fetchall()
-    for r in row:
-        if r and r[0]:
-            print (r[0])
+    ####################################################################################################################
+    ### add_item
+    ####################################################################################################################
+    def add_item (self, item_type: str, text: str):
+        """Add one item of item_type (see ADD_OPTIONS). Returns its item_id, or False."""
+        ids = self.add_items ([(item_type, text)])
+        if not ids:
+            return False
+        return ids[0]
+
+    ####################################################################################################################
+    ### add_items
+    ####################################################################################################################
+    def add_items (self, items: list):
+        """Add (item_type, text) items, all stamped with the same time. Returns their item_ids in order, or False."""
+        now = self.ts_value ()
+        s = """INSERT INTO item VALUES (NULL, ?, ?, NULL, False, False, ?)"""
+        ids = []
+        try:
+            for item_type, text in items:
+                self.cur.execute(s, (item_type, now, text))
+                # The id of this connection's own insert, whatever other writers are doing.
+                ids.append (self.cur.lastrowid)
+        except sql.Error as em:
+            print ("*** Error: {} '{}'".format(s, em))
+            return False
+        return ids
+
+    ####################################################################################################################
+    ### do_edit
+    ####################################################################################################################
+    def do_edit (self, id: str, itm: str) -> bool:
+        # Build the INSERT
+        s = """UPDATE item SET item = ?, updt = ? WHERE item_id = ?"""
+        try:
+            self.cur.execute(s, (itm, self.ts_value (), id))
+        except sql.Error as em:
+            print ("*** Error: {} '{}'".format(s, em))
+            return False
+        if self.cur.rowcount != 1:
+            print ("*** Error: no item with item_id {}".format (id))
+            return False
+        return True
 
-    cur.close()
-    con.close()
-    return True
+    ####################################################################################################################
+    ### do_recent
+    ####################################################################################################################
+    def do_recent (self, num: int = 5, window: tuple = (None, None)) -> bool:
+        '''Print the last num items to the screen, sorted by todo,  others.'''
+        w, params = self.window_sql (window)
+        s = '{}: {}: {}: {}: {}: {}'.format(' ** TYPE ** ', ' ** PAGE ** ',' ** ITEM_ID ** ', ' ** CREATED ** ', ' ** UPDATED ** ',' ** ITEM ** ')
+        print (s)
+        # Each SELECT walks its index backwards and stops after num rows, which are then put back in date order, so
+        # the cost does not grow with the size of the journal.
+        print ("\n*** Logs, ideas, quotes, notes ***\n")
+        s = """SELECT * FROM (SELECT * FROM item WHERE item_type NOT IN ('NONE','TODO'){} ORDER BY dtime DESC, item_id DESC LIMIT ?)
+               ORDER BY dtime, item_id""".format(w)
+        if not self.ls_rows (s, params + [num], " *** No items to output *** "):
+            return False
+        # Next, grab completed todos and print them.
+        print ("\n*** Completed todos ***\n")
+        s = """SELECT * FROM (SELECT * FROM item WHERE item_type = 'TODO' AND is_done = 1{} ORDER BY item_id DESC LIMIT ?)
+               ORDER BY item_id""".format(w)
+        if not self.ls_rows (s, params + [num], " *** No completed todo items *** \n"):
+            return False
+        # Next, grab current todos and print them.
+        print ("\n*** Open todos ***\n")
+        s = """SELECT * FROM (SELECT * FROM item WHERE item_type = 'TODO' AND is_done = 0{} ORDER BY item_id DESC LIMIT ?)
+               ORDER BY item_id""".format(w)
+        if not self.ls_rows (s, params + [num], " *** No open todo items *** \n"):
+            return False
+        # Done
+        return True
 
-########################################################################################################################
-### do_show_todo
-########################################################################################################################
-def do_show_todo (fn: str, id: str) -> bool:
-    """Show the item and pg  for todo in fn given by id."""
-    # Open journal file
-    try:
-        con = sql.connect (fn)
-        cur = con.cursor()
-    except sql.Error as em:
-        print ("*** SQLite error opening Journal file: {}".format (em))
-        return False
+    ####################################################################################################################
+    ### do_ls
+    ####################################################################################################################
+    def do_ls (self, limit: int = None, after_id: int = None, before: str = None, window: tuple = (None, None)) -> bool:
+        '''Print all items to the screen, sorted by todo, completed todo and others.'''
+        after = None
+        if after_id is not None:
+            after = self.keyset_anchor (after_id)
+            if not after:
+                return False
+        s = '{}: {}: {}: {}: {}: {}'.format(' ** TYPE ** ', ' ** PAGE ** ',' ** ITEM_ID ** ', ' ** CREATED ** ', ' ** UPDATED ** ',' ** ITEM ** ')
+        print (s)
+        w, wp = self.window_sql (window)
+        print ("\n*** Logs, ideas, quotes, notes ***\n")
+        s, params = self.page_sql ("item_type NOT IN ('NONE','TODO')" + w, wp, 'dtime', limit, after, before)
+        if not self.ls_rows (s, params, " *** No items to output *** "):
+            return False
+        # Next, grab completed todos and print them.
+        print ("\n*** Completed todos ***\n")
+        s, params = self.page_sql ("item_type = 'TODO' AND is_done = 1" + w, wp, 'item_id', limit, after, before)
+        if not self.ls_rows (s, params, " *** No completed todo items *** \n"):
+            return False
+        # Next, grab current todos and print them.
+        print ("\n*** Open todos ***\n")
+        s, params = self.page_sql ("item_type = 'TODO' AND is_done = 0" + w, wp, 'item_id', limit, after, before)
+        if not self.ls_rows (s, params, " *** No open todo items *** \n"):
+            return False
+        # Done
+        return True
 
-    # Verify it is a sqlite journal file.
-    try:
-        cur.execute('SELECT * FROM item WHERE item_type = "NONE"')
-    except sql.Error as em:
-        print ("***Error: {} '{}'".format(args.filename, em))
-        cur.close()
-        con.close()
-        return False
-    # Good sqlite file. Proceed.
+    ####################################################################################################################
+    ### do_ls_all
+    ####################################################################################################################
+    def do_ls_all (self, limit: int = None, after_id: int = None, before: str = None, window: tuple = (None, None)) -> bool:
+        '''Print all the items without sorting by todo and non-todo, only by date. Works only with --ls.'''
+        after = None
+        if after_id is not None:
+            after = self.keyset_anchor (after_id)
+            if not after:
+                return False
+        s = '{}: {}: {}: {}: {}: {}'.format(' ** TYPE ** ', ' ** PAGE ** ',' ** ITEM_ID ** ', ' ** CREATED ** ', ' ** UPDATED ** ',' ** ITEM ** ')
+        print (s)
+        print ("\n*** Logs, ideas, quotes, notes ***\n")
+        w, wp = self.window_sql (window)
+        s, params = self.page_sql ("item_type IS NOT 'NONE'" + w, wp, 'dtime', limit, after, before)
+        if not self.ls_rows (s, params, " *** No items to output *** "):
+            return False
+        # Done
+        return True
 
-    s = """SELECT * FROM item WHERE item_type IS 'TODO' AND is_done IS 0 AND item_id IS {}""".format(id)
-    try:
-        cur.execute(s)
-    except sql.Error as em:
-        print ("*** Error: {} '{}'".format(s, em))
-        cur.close()
-        con.close()
-        return False
-    r = cur.fetchone()
-    # 0 = item_id, 1 = item_type, 2 = dtime, 3 = updt, 4 = is_pg, 5 = is_done, 6 = item
-    bullet = todo
-    pg = str
-    if not r:
-        return False
-    if r[4] and r[4] == 0:
-        pg = non
-    else:
-        pg = page
-    s = '{0} : {1} : {2:>5d}: {3:<19s}: {4:<19s} | {5}'.format (bullet, pg, r[0], str(r[2]), str(r[3]), r[6])
-    print (s)
+    ####################################################################################################################
+    ### keyset_anchor
+    ####################################################################################################################
+    def keyset_anchor (self, id: int) -> tuple:
+        """Return the (dtime, item_id) sort key of item id, used to page a listing with --after_id."""
+        s = """SELECT dtime, item_id FROM item WHERE item_id = ?"""
+        try:
+            self.cur.execute(s, (int(id),))
+        except sql.Error as em:
+            print ("*** Error: {} '{}'".format(s, em))
+            return None
+        r = self.cur.fetchone()
+        if not r:
+            print ("*** Error: no item with item_id {} to page after".format (id))
+            return None
+        return r
+
+    ####################################################################################################################
+    ### page_sql
+    ####################################################################################################################
+    def page_sql (self, where: str, params: list, order: str, limit: int, after: tuple, before: str) -> tuple:
+        """Build the SELECT for one listing section, paged by keyset on its sort order ('dtime' or 'item_id'), and the
+        values it binds (params holds those of where).
+
+        Pages are found by seeking the item_dtime/item_id indexes to the anchor, never by OFFSET, so page 500 costs
+        the same as page 1. With --before and no --after_id the section pages backwards from the cutoff.
+        """
+        params = list (params)
+        if order == 'dtime':
+            keys = 'dtime, item_id'
+            desc = 'dtime DESC, item_id DESC'
+            if after:
+                where += " AND (dtime, item_id) > (?, ?)"
+                params += [after[0], after[1]]
+        else:
+            keys = 'item_id'
+            desc = 'item_id DESC'
+            if after:
+                where += " AND item_id > ?"
+                params.append (after[1])
+        if before:
+            where += " AND dtime < ?"
+            params.append (self.ts_value (before))
+        if limit is None:
+            return """SELECT * FROM item WHERE {} ORDER BY {}""".format (where, keys), params
+        params.append (int(limit))
+        if before and not after:
+            return """SELECT * FROM (SELECT * FROM item WHERE {} ORDER BY {} LIMIT ?) ORDER BY {}""".format (where, desc, keys), params
+        return """SELECT * FROM item WHERE {} ORDER BY {} LIMIT ?""".format (where, keys), params
+
+    ####################################################################################################################
+    ### ls_rows
+    ####################################################################################################################
+    def ls_rows (self, s: str, params: list, empty: str) -> bool:
+        """Run the SELECT in s with params and stream the formatted rows to stdout, or print empty if there are none."""
+        try:
+            self.cur.execute(s, params)
+        except sql.Error as em:
+            print ("*** Error: {} '{}'".format(s, em))
+            return False
+        # Rows are pulled FETCH_ROWS at a time and written straight through the stdout buffer, so memory stays flat
+        # and the first line goes out before the rest of the journal is read.
+        write = sys.stdout.write
+        n = 0
+        rows = self.cur.fetchmany (FETCH_ROWS)
+        while rows:
+            write ('\n'.join ([fmt_item (r) for r in rows]))
+            write ('\n')
+            n += len(rows)
+            rows = self.cur.fetchmany (FETCH_ROWS)
+        if n == 0:
+            print (empty)
+        return True
 
-    s = """SELECT data FROM page WHERE item_id IS {}""".format(id)
-    try:
-        cur.execute(s)
-    except sql.Error as em:
-        print ("*** Error: {} '{}'".format(s, em))
-        cur.close()
-        con.close()
-        return False
-    row = cur.fetchall()
-    for r in row:
-        if r and r[0]:
-            print (r[0])
-    print (legend)
+    ####################################################################################################################
+    ### do_rm
+    ####################################################################################################################
+    def do_rm (self, id: str) -> bool:
+        """Move an item, and its page, to the archive table."""
+        # Copy the item across with its page and the time it was archived. The page text goes from table to table
+        # inside SQLite, never through Python.
+        s = """INSERT INTO archive SELECT item_id, item_type, dtime, updt, ?, item,
+                   (SELECT {} FROM page WHERE page.item_id = item.item_id)
+               FROM item WHERE item_id = ?""".format (PAGE_TEXT_SQL)
+        try:
+            self.cur.execute(s, (self.ts_value (), id))
+        except sql.Error as em:
+            print ("*** Error: {} '{}'".format(s, em))
+            return False
+        if self.cur.rowcount != 1:
+            print ("*** Error: no item with item_id {}".format (id))
+            return False
+        s = """DELETE FROM item WHERE item_id = ?"""
+        try:
+            self.cur.execute(s, (id,))
+        except sql.Error as em:
+            print ("*** Error: {} '{}'".format(s, em))
+            return False
+        return True
 
+    ####################################################################################################################
+    ### do_pg
+    ####################################################################################################################
+    def do_pg (self, id: str, file: str, max_mb: int = None, codec: str = None) -> bool:
+        """Associate a page of data to an item. The file is streamed into a BLOB PAGE_CHUNK bytes at a time, so
+        memory use does not grow with its size. A file over max_mb megabytes is refused. With codec the page is
+        stored compressed, unless that does not make it any smaller. A pipe or FIFO (/dev/stdin, <(cmd)) is spooled
+        to a temporary file first."""
+        limit = max_mb * 1024 * 1024 if max_mb is not None else None
+        try:
+            f = open (file, 'rb')
+            if not stat.S_ISREG (os.fstat (f.fileno()).st_mode):
+                f = self.spool_file (f, limit)
+            size = os.fstat (f.fileno()).st_size if f else None
+        except OSError as em:
+            print ("*** Error: {} '{}'".format(file, em))
+            return False
+        if f is None or (limit is not None and size > limit):
+            print ("*** Error: {} is over the --max_page limit of {} MB".format (file, max_mb))
+            if f:
+                f.close ()
+            return False
+        with f:
+            try:
+                # A file small enough to diff against the page it replaces is read once as text, for the history.
+                new = None
+                if size <= HISTORY_DIFF_MAX:
+                    new = page_text (f.read ())
+                    f.seek (0)
+                src = f
+                n = size
+                if codec:
+                    spool = self.compress_chunks (iter (lambda: f.read (PAGE_CHUNK), b''), codec)
+                    if spool.tell () < size:
+                        src = spool
+                        n = spool.tell ()
+                        spool.seek (0)
+                    else:
+                        codec = None
+                        f.seek (0)
+            except OSError as em:
+                print ("*** Error: {} '{}'".format(file, em))
+                return False
+            now = self.ts_value ()
+            try:
+                self.save_page_rev (id, new)
+            except (sql.Error,) + CODEC_ERRORS as em:
+                print ("*** Error: page history of item {} '{}'".format(id, em))
+                return False
+            # Room for the whole page is allocated up front, in the item's one page row, and then filled in place.
+            s = """INSERT INTO page (item_id, dtime, updt, data, codec) VALUES (?, ?, NULL, zeroblob(?), ?)
+                   ON CONFLICT (item_id) DO UPDATE SET updt = excluded.dtime, data = excluded.data, codec = excluded.codec"""
+            try:
+                self.cur.execute(s, (id, now, n, codec))
+                self.cur.execute("SELECT rowid FROM page WHERE item_id = ?", (id,))
+                rowid = self.cur.fetchone()[0]
+                ok = self.fill_blob (rowid, src, n)
+            except sql.Error as em:
+                print ("*** Error: {} '{}'".format(s, em))
+                return False
+            except ValueError:
+                ok = False
+            if src is not f:
+                src.close ()
+            if not ok or f.tell () != size:
+                print ("*** Error: {} changed size while it was being read".format (file))
+                return False
+        # The page triggers skip BLOB pages; index the finished page here.
+        if self.fts:
+            s = """UPDATE item_fts SET data = (SELECT {} FROM page WHERE rowid = ?) WHERE rowid = ?""".format (PAGE_TEXT_SQL)
+            try:
+                self.cur.execute(s, (rowid, id))
+            except sql.Error as em:
+                print ("*** Error: {} '{}'".format(s, em))
+                return False
+        s = """UPDATE item SET updt = ?, is_pg = TRUE WHERE item_id = ?"""
+        try:
+            self.cur.execute(s, (now, id))
+        except sql.Error as em:
+            print ("*** Error: {} '{}'".format(s, em))
+            return False
+        # No such item: the caller rolls the page back with the rest of the transaction.
+        if self.cur.rowcount != 1:
+            print ("*** Error: no item with item_id {}".format (id))
+            return False
+        # Done
+        return True
 
-    cur.close()
-    con.close()
-    return True
- 
+    ####################################################################################################################
+    ### spool_file
+    ####################################################################################################################
+    def spool_file (self, f, limit: int = None):
+        """Copy the stream f into a temporary file PAGE_CHUNK bytes at a time and close f. Returns the temporary file,
+        rewound, or None if f holds more than limit bytes."""
+        spool = tempfile.TemporaryFile ()
+        with f:
+            for chunk in iter (lambda: f.read (PAGE_CHUNK), b''):
+                spool.write (chunk)
+                if limit is not None and spool.tell () > limit:
+                    spool.close ()
+                    return None
+        spool.seek (0)
+        return spool
+
+    ####################################################################################################################
+    ### compress_chunks
+    ####################################################################################################################
+    def compress_chunks (self, chunks, codec: str):
+        """Compress the byte chunks with codec into a temporary file, left positioned at its end."""
+        spool = tempfile.TemporaryFile ()
+        comp = PAGE_CODECS[codec][0] ()
+        for chunk in chunks:
+            spool.write (comp.compress (chunk))
+        spool.write (comp.flush ())
+        return spool
+
+    ####################################################################################################################
+    ### fill_blob
+    ####################################################################################################################
+    def fill_blob (self, rowid: int, f, size: int) -> bool:
+        """Copy file f into the preallocated page data of rowid. True if it filled exactly size bytes; ValueError if
+        f holds more."""
+        with self.con.blobopen ('page', 'data', rowid) as blob:
+            chunk = f.read (PAGE_CHUNK)
+            while chunk:
+                blob.write (chunk)
+                chunk = f.read (PAGE_CHUNK)
+            return blob.tell () == size
+
+    ####################################################################################################################
+    ### page_chunks
+    ####################################################################################################################
+    def page_chunks (self, rowid: int, codec: str, table: str = 'page'):
+        """Yield the plain bytes of the page in rowid of table (page or page_rev), PAGE_CHUNK stored bytes at a time."""
+        d = PAGE_CODECS[codec][1] () if codec else None
+        with self.con.blobopen (table, 'data', rowid, readonly=True) as blob:
+            chunk = blob.read (PAGE_CHUNK)
+            while chunk:
+                yield d.decompress (chunk) if d else chunk
+                chunk = blob.read (PAGE_CHUNK)
+        if d and hasattr (d, 'flush'):
+            yield d.flush ()
+
+    ####################################################################################################################
+    ### do_pg_text
+    ####################################################################################################################
+    def do_pg_text (self, id: str, t: str) -> bool:
+        """Associate the text t to an item as its page."""
+        now = self.ts_value ()
+        try:
+            self.save_page_rev (id, t if len(t) <= HISTORY_DIFF_MAX else None)
+        except (sql.Error,) + CODEC_ERRORS as em:
+            print ("*** Error: page history of item {} '{}'".format(id, em))
+            return False
+        # The text is bound as it is: no quoting, no copy.
+        s = """INSERT INTO page (item_id, dtime, updt, data, codec) VALUES (?, ?, NULL, ?, NULL)
+               ON CONFLICT (item_id) DO UPDATE SET updt = excluded.dtime, data = excluded.data, codec = NULL"""
+        try:
+            self.cur.execute(s, (id, now, t))
+        except sql.Error as em:
+            print ("*** Error: {} '{}'".format(s, em))
+            return False
+        s = """UPDATE item SET updt = ?, is_pg = TRUE WHERE item_id = ?"""
+        try:
+            self.cur.execute(s, (now, id))
+        except sql.Error as em:
+            print ("*** Error: {} '{}'".format(s, em))
+            return False
+        # No such item: the caller rolls the page back with the rest of the transaction.
+        if self.cur.rowcount != 1:
+            print ("*** Error: no item with item_id {}".format (id))
+            return False
+        # Done
+        return True
 
-########################################################################################################################
-### do_dump
-########################################################################################################################
-def do_dump (fn: str) -> bool:
-    """Dump all items, including pages."""
-    # Open journal file
-    try:
-        con = sql.connect (fn)
-        cur = con.cursor()
-    except sql.Error as em:
-        print ("*** SQLite error opening Journal file: {}".format (em))
-        return False
+    ####################################################################################################################
+    ### save_page_rev
+    ####################################################################################################################
+    def save_page_rev (self, id: str, new: str = None) -> None:
+        """Keep the page of item id, about to be replaced by the text new, as its newest revision in page_rev. new is
+        None when the new page is too big to diff. Raises sql.Error."""
+        s = """SELECT rowid, COALESCE(updt, dtime), codec FROM page WHERE item_id = ? AND data IS NOT NULL"""
+        self.cur.execute(s, (id,))
+        r = self.cur.fetchone()
+        if not r:
+            return
+        rowid, t, codec = r
+        self.cur.execute("SELECT COALESCE(MAX(rev), 0) + 1 FROM page_rev WHERE item_id = ?", (id,))
+        rev = self.cur.fetchone()[0]
+        old = self.read_page (rowid, codec, HISTORY_DIFF_MAX)
+        if old is None:
+            # Too big to diff: copy the page across as it is stored, inside SQLite.
+            s = """INSERT INTO page_rev (item_id, rev, dtime, data, codec)
+                   SELECT item_id, ?, ?, data, codec FROM page WHERE rowid = ?"""
+            self.cur.execute(s, (rev, t, rowid))
+        elif new is None or rev % HISTORY_KEYFRAME == 0:
+            s = """INSERT INTO page_rev (item_id, rev, dtime, data, codec) VALUES (?, ?, ?, ?, 'zlib')"""
+            self.cur.execute(s, (id, rev, t, zlib.compress (old, 9)))
+        else:
+            s = """INSERT INTO page_rev (item_id, rev, dtime, delta) VALUES (?, ?, ?, ?)"""
+            self.cur.execute(s, (id, rev, t, page_delta (new, page_text (old))))
+
+    ####################################################################################################################
+    ### read_page
+    ####################################################################################################################
+    def read_page (self, rowid: int, codec: str, limit: int, table: str = 'page') -> bytes:
+        """The plain bytes of the page in rowid of table, or None if they come to more than limit."""
+        out = []
+        n = 0
+        for chunk in self.page_chunks (rowid, codec, table):
+            n += len(chunk)
+            if n > limit:
+                return None
+            out.append (chunk)
+        return b''.join (out)
+
+    ####################################################################################################################
+    ### page_rev_text
+    ####################################################################################################################
+    def page_rev_text (self, id: str, rev: int) -> str:
+        """Rebuild revision rev of the page of item id: start from the first full copy at or after rev, or the current
+        page if there is none, and apply the reverse deltas from there back down to rev. Raises sql.Error."""
+        self.cur.execute("SELECT MIN(rev) FROM page_rev WHERE item_id = ? AND rev >= ? AND delta IS NULL", (id, rev))
+        top = self.cur.fetchone()[0]
+        if top is None:
+            table = 'page'
+            s = """SELECT rowid, codec FROM page WHERE item_id = ? AND data IS NOT NULL"""
+            self.cur.execute(s, (id,))
+            top = sys.maxsize
+        else:
+            table = 'page_rev'
+            self.cur.execute("SELECT rowid, codec FROM page_rev WHERE item_id = ? AND rev = ?", (id, top))
+        r = self.cur.fetchone()
+        text = page_text (b''.join (self.page_chunks (r[0], r[1], table))) if r else ''
+        s = """SELECT delta FROM page_rev WHERE item_id = ? AND rev >= ? AND rev < ? ORDER BY rev DESC"""
+        self.cur.execute(s, (id, rev, top))
+        for (delta,) in self.cur.fetchall():
+            text = apply_delta (text, delta)
+        return text
+
+    ####################################################################################################################
+    ### do_pg_history
+    ####################################################################################################################
+    def do_pg_history (self, id: str) -> bool:
+        """List the revisions of the page of item id, oldest first."""
+        s = """SELECT rev, dtime, delta IS NULL FROM page_rev WHERE item_id = ? ORDER BY rev"""
+        try:
+            self.cur.execute(s, (id,))
+            rows = self.cur.fetchall()
+            self.cur.execute("SELECT COALESCE(updt, dtime) FROM page WHERE item_id = ? AND data IS NOT NULL", (id,))
+            cur = self.cur.fetchone()
+        except sql.Error as em:
+            print ("*** Error: {} '{}'".format(s, em))
+            return False
+        if not rows and not cur:
+            print ("Item {} has no page.".format (id))
+            return False
+        print ("Page history of item {}, {} revisions:".format (id, len(rows) + (1 if cur else 0)))
+        for rev, t, full in rows:
+            print ("{:>6d}  {}  {}".format (rev, fmt_ts (t), 'full copy' if full else 'delta'))
+        if cur:
+            print ("{:>6d}  {}  {}".format (len(rows) + 1, fmt_ts (cur[0]), 'current'))
+        return True
 
-    # Verify it is a sqlite journal file.
-    try:
-        cur.execute('SELECT * FROM item WHERE item_type = "NONE"')
-    except sql.Error as em:
-        print ("***Error: {} '{}'".format(args.filename, em))
-        cur.close()
-        con.close()
-        return False
-    # Good sqlite file. Proceed.
+    ####################################################################################################################
+    ### do_pg_at
+    ####################################################################################################################
+    def do_pg_at (self, id: str, dt: str) -> bool:
+        """Show the page of item id as it was at the local time dt: the newest revision written by then."""
+        t = self.ts_value (dt)
+        s = """SELECT COALESCE(updt, dtime) FROM page WHERE item_id = ? AND data IS NOT NULL AND COALESCE(updt, dtime) <= ?"""
+        try:
+            self.cur.execute(s, (id, t))
+            cur = self.cur.fetchone()
+            self.cur.execute("SELECT MAX(rev) FROM page_rev WHERE item_id = ?", (id,))
+            n = (self.cur.fetchone()[0] or 0) + 1
+            if not cur:
+                self.cur.execute("SELECT MAX(rev) FROM page_rev WHERE item_id = ? AND dtime <= ?", (id, t))
+                rev = self.cur.fetchone()[0]
+                if rev is None:
+                    print ("Item {} had no page at {}.".format (id, dt))
+                    return False
+                self.cur.execute("SELECT dtime FROM page_rev WHERE item_id = ? AND rev = ?", (id, rev))
+                when = self.cur.fetchone()[0]
+            self.cur.execute("SELECT * FROM item WHERE item_id IS ?", (id,))
+            r = self.cur.fetchone()
+        except sql.Error as em:
+            print ("*** Error: {} '{}'".format(s, em))
+            return False
+        if r:
+            print (fmt_item (r))
+        if cur:
+            # The current page: stream it like --show_pg.
+            print ("Page revision {} of {}, from {}:".format (n, n, fmt_ts (cur[0])))
+            return self.print_page (id)
+        print ("Page revision {} of {}, from {}:".format (rev, n, fmt_ts (when)))
+        try:
+            text = self.page_rev_text (id, rev)
+        except (sql.Error,) + CODEC_ERRORS as em:
+            print ("*** Error: page of item {} '{}'".format(id, em))
+            return False
+        if text:
+            sys.stdout.write (text)
+            sys.stdout.write ('\n')
+        return True
 
-    s = """SELECT item_id FROM item ORDER BY dtime"""
-    try:
-        cur.execute(s)
-    except sql.Error as em:
-        print ("*** Error: {} '{}'".format(s, em))
-        cur.close()
-        con.close()
-        return False
-    row = cur.fetchall()
-    for r in row:
+    ####################################################################################################################
+    ### do_show_pg
+    ####################################################################################################################
+    def do_show_pg (self, id: str) -> bool:
+        """Show the pg given by id."""
+        s = """SELECT * FROM item WHERE item_id IS ?"""
+        try:
+            self.cur.execute(s, (id,))
+        except sql.Error as em:
+            print ("*** Error: {} '{}'".format(s, em))
+            return False
+        r = self.cur.fetchone()
         if not r:
-            continue
-        rtn = do_show_pg (fn, r[0])
-        if not rtn:
+            print ("*** Error: no item with item_id {}".format (id))
             return False
-    cur.close()
-    con.close()
-    return True
+        print (fmt_item (r))
+        return self.print_page (id)
+
+    ####################################################################################################################
+    ### print_page
+    ####################################################################################################################
+    def print_page (self, id: str) -> bool:
+        """Stream the page of item id to stdout PAGE_CHUNK bytes at a time. A large page starts showing at once and is
+        never held in memory whole."""
+        s = """SELECT rowid, codec FROM page WHERE item_id IS ? AND data IS NOT NULL"""
+        try:
+            self.cur.execute(s, (id,))
+        except sql.Error as em:
+            print ("*** Error: {} '{}'".format(s, em))
+            return False
+        # page is keyed by item_id: there is at most one row.
+        r = self.cur.fetchone()
+        if not r:
+            return True
+        rowid, codec = r
+        write = sys.stdout.write
+        # A chunk can end part way through a UTF-8 character; the decoder holds on to it until the rest arrives.
+        dec = codecs.getincrementaldecoder ('utf-8') ('replace')
+        n = 0
+        try:
+            for chunk in self.page_chunks (rowid, codec):
+                n += len(chunk)
+                write (dec.decode (chunk))
+            write (dec.decode (b'', True))
+        except (sql.Error,) + CODEC_ERRORS as em:
+            print ("*** Error: page of item {} '{}'".format(id, em))
+            return False
+        if n:
+            write ('\n')
+        return True
 
-########################################################################################################################
-### do_dump_cmd_line
-########################################################################################################################
-def do_dump_cmd_line (fn: str) -> bool:
-    """Dump all commands."""
-    # Open journal file
-    try:
-        con = sql.connect (fn)
-        cur = con.cursor()
-    except sql.Error as em:
-        print ("*** SQLite error opening Journal file: {}".format (em))
-        return False
+    ####################################################################################################################
+    ### do_show_todo
+    ####################################################################################################################
+    def do_show_todo (self, id: str) -> bool:
+        """Show the item and pg  for todo given by id."""
+        s = """SELECT * FROM item WHERE item_type IS 'TODO' AND is_done IS 0 AND item_id IS ?"""
+        try:
+            self.cur.execute(s, (id,))
+        except sql.Error as em:
+            print ("*** Error: {} '{}'".format(s, em))
+            return False
+        r = self.cur.fetchone()
+        if not r:
+            print ("*** Error: no open todo with item_id {}".format (id))
+            return False
+        print (fmt_item (r))
 
-    # Verify it is a sqlite journal file.
-    try:
-        cur.execute('SELECT * FROM item WHERE item_type = "NONE"')
-    except sql.Error as em:
-        print ("***Error: {} '{}'".format(args.filename, em))
-        cur.close()
-        con.close()
-        return False
-    # Good sqlite file. Proceed.
+        if not self.print_page (id):
+            return False
+        print (legend)
+        return True
+     
+
+    ####################################################################################################################
+    ### do_dump
+    ####################################################################################################################
+    def do_dump (self, window: tuple = (None, None)) -> bool:
+        """Dump all items, including pages."""
+        # One pass over item in date order with its page, if any, joined in. Rows are printed as they come off the
+        # cursor.
+        w, params = self.window_sql (window, 'item.dtime')
+        s = """SELECT item.item_id, item.item_type, item.dtime, item.updt, item.is_pg, item.is_done, item.item, {}
+               FROM item LEFT JOIN page ON page.item_id = item.item_id
+               WHERE 1{}
+               ORDER BY item.dtime, item.item_id""".format (PAGE_TEXT_SQL, w)
+        try:
+            self.cur.execute(s, params)
+        except sql.Error as em:
+            print ("*** Error: {} '{}'".format(s, em))
+            return False
+        # 0 = item_id, 1 = item_type, 2 = dtime, 3 = updt, 4 = is_pg, 5 = is_done, 6 = item, 7 = page data
+        last_id = None
+        for r in self.cur:
+            if r[0] != last_id:
+                print (fmt_item (r))
+                last_id = r[0]
+            if r[7]:
+                print (page_text (r[7]))
+        return True
 
-    s = """SELECT cmd FROM cmd_line ORDER BY dtime"""
-    try:
-        cur.execute(s)
-    except sql.Error as em:
-        print ("*** Error: {} '{}'".format(s, em))
-        cur.close()
-        con.close()
-        return False
-    row = cur.fetchall()
-    for r in row:
-        if not r:
-            continue
-        print (r[0])
-    cur.close()
-    con.close()
-    return True
+    ####################################################################################################################
+    ### do_dump_cmd_line
+    ####################################################################################################################
+    def do_dump_cmd_line (self, window: tuple = (None, None)) -> bool:
+        """Dump all commands."""
+        w, params = self.window_sql (window)
+        s = """SELECT cmd FROM cmd_line WHERE 1{} ORDER BY dtime""".format (w)
+        try:
+            self.cur.execute(s, params)
+        except sql.Error as em:
+            print ("*** Error: {} '{}'".format(s, em))
+            return False
+        row = self.cur.fetchall()
+        for r in row:
+            if not r:
+                continue
+            print (r[0])
+        return True
 
-########################################################################################################################
-### do_show_all_todos
-########################################################################################################################
-def do_show_all_todos (fn: str) -> bool:
-    """Show the items and pgs for all todos."""
-    # Open journal file
-    try:
-        con = sql.connect (fn)
-        cur = con.cursor()
-    except sql.Error as em:
-        print ("*** SQLite error opening Journal file: {}".format (em))
-        return False
+    ####################################################################################################################
+    ### do_show_all_todos
+    ####################################################################################################################
+    def do_show_all_todos (self, lo: int = None, hi: int = None, limit: int = None, window: tuple = (None, None)) -> bool:
+        """Show the items and pgs for all open todos, optionally only item_ids lo..hi and at most limit of them."""
+        w, params = self.window_sql (window)
+        where = "item_type = 'TODO' AND is_done = 0" + w
+        if lo is not None:
+            where += " AND item_id >= ?"
+            params.append (int(lo))
+        if hi is not None:
+            where += " AND item_id <= ?"
+            params.append (int(hi))
+        lim = ""
+        if limit is not None:
+            lim = " LIMIT ?"
+            params.append (int(limit))
+        # One pass over the open todos with their pages joined in, in item_id order.
+        s = """SELECT item.item_id, item.item_type, item.dtime, item.updt, item.is_pg, item.is_done, item.item, {}
+               FROM (SELECT * FROM item WHERE {} ORDER BY item_id{}) AS item
+               LEFT JOIN page ON page.item_id = item.item_id
+               ORDER BY item.item_id""".format (PAGE_TEXT_SQL, where, lim)
+        try:
+            self.cur.execute(s, params)
+        except sql.Error as em:
+            print ("*** Error: {} '{}'".format(s, em))
+            return False
+        # 0 = item_id, 1 = item_type, 2 = dtime, 3 = updt, 4 = is_pg, 5 = is_done, 6 = item, 7 = page data
+        last_id = None
+        for r in self.cur:
+            if r[0] != last_id:
+                print ("\n")
+                print (fmt_item (r))
+                last_id = r[0]
+            if r[7]:
+                print (page_text (r[7]))
+        print (legend)
+        return True
 
-    # Verify it is a sqlite journal file.
-    try:
-        cur.execute('SELECT * FROM item WHERE item_type = "NONE"')
-    except sql.Error as em:
-        print ("***Error: {} '{}'".format(args.filename, em))
-        cur.close()
-        con.close()
-        return False
-    # Good sqlite file. Proceed.
+    ####################################################################################################################
+    ### import_row
+    ####################################################################################################################
+    def import_row (self, r: dict) -> tuple:
+        """Check one --import record and return (item_type, dtime, updt, is_done, item, page) ready to bind."""
+        if isinstance (r, str):
+            r = json.loads (r)
+        item_type = str(r.get ('type') or '').strip().upper()
+        if item_type not in bullets:
+            raise ValueError ("unknown type '{}'".format (r.get ('type')))
+        item = r.get ('text', r.get ('item'))
+        if item is None or str(item) == '':
+            raise ValueError ("no text")
+        ts = []
+        for k in ('dtime', 'updt'):
+            v = r.get (k) or None
+            if v is not None:
+                d = datetime.datetime.fromisoformat (str(v).strip())
+                # A time with a UTC offset is stored as the local time it stands for, like every other timestamp.
+                if d.tzinfo is not None:
+                    d = d.astimezone().replace (tzinfo=None)
+                v = self.ts_value (d.isoformat (' ', 'seconds'))
+            ts.append (v)
+        if ts[0] is None:
+            ts[0] = self.ts_value ()
+        done = r.get ('done') or False
+        if isinstance (done, str):
+            done = done.strip().lower() in ('1', 'true', 'yes', 'y', 'x', 'done')
+        page = r.get ('page') or None
+        return (item_type, ts[0], ts[1], int(bool(done)) if item_type == 'TODO' else 0, str(item), page)
+
+    ####################################################################################################################
+    ### do_import
+    ####################################################################################################################
+    def do_import (self, src: str) -> bool:
+        """Bulk load items (and pages) from a JSONL or CSV file, or from stdin when src is '-'."""
+        if src == '-':
+            fh = sys.stdin
+            fmt = None
+        else:
+            try:
+                fh = open (src, 'r', newline='')
+            except OSError as em:
+                print ("*** Error: {} '{}'".format(src, em))
+                return False
+            fmt = 'csv' if src.lower().endswith ('.csv') else 'jsonl' if src.lower().endswith (('.jsonl', '.json')) else None
+        f = fh
+        if fmt is None:
+            # Sniff it: JSONL records start with '{', anything else is taken as CSV with a header row.
+            try:
+                first = fh.readline()
+            except (UnicodeDecodeError, OSError) as em:
+                print ("*** Error: {} '{}'".format(src, em))
+                if fh is not sys.stdin:
+                    fh.close()
+                return False
+            fmt = 'jsonl' if first.lstrip().startswith ('{') else 'csv'
+            f = itertools.chain ([first], fh)
+        # Row by row, the full-text triggers cost more than the inserts themselves. Each batch drops them, fills
+        # item_fts with one executemany and puts them back before it commits, so the index is never out of step.
+        try:
+            self.cur.execute ("""SELECT sql FROM sqlite_master WHERE type = 'trigger'
+                                 AND name IN ('item_fts_insert','page_fts_insert')""")
+        except sql.Error as em:
+            print ("*** Error: {} '{}'".format(self.fn, em))
+            return False
+        fts = [r[0] for r in self.cur.fetchall()]
+        counts = {}
+        first_id = last_id = None
+        skipped = 0
+        items = []
+        pages = []
+        text = []
+        recs = import_records (f, fmt)
+        # Ids are handed out here rather than by AUTOINCREMENT, so the pages of a batch can be written with one
+        # executemany as well. The write lock is held from the read of the sequence to the commit.
+        while True:
+            try:
+                self.begin ()
+                self.cur.execute ("SELECT seq FROM sqlite_sequence WHERE name = 'item'")
+                r = self.cur.fetchone()
+                next_id = (r[0] if r else 0) + 1
+                items.clear()
+                pages.clear()
+                text.clear()
+                for n, rec in recs:
+                    try:
+                        t = self.import_row (rec)
+                    except (ValueError, AttributeError) as em:
+                        print ("*** Warning: {} line {}: {} - skipped".format (src, n, em))
+                        skipped += 1
+                        continue
+                    items.append ((next_id, t[0], t[1], t[2], 1 if t[5] else 0, t[3], t[4]))
+                    if t[5]:
+                        pages.append ((next_id, t[1], str(t[5])))
+                    text.append ((next_id, t[4], str(t[5] or '')))
+                    counts[t[0]] = counts.get (t[0], 0) + 1
+                    next_id += 1
+                    if len(items) >= IMPORT_ROWS:
+                        break
+                if fts:
+                    self.cur.execute ('DROP TRIGGER item_fts_insert')
+                    self.cur.execute ('DROP TRIGGER page_fts_insert')
+                self.cur.executemany ("INSERT INTO item VALUES (?,?,?,?,?,?,?)", items)
+                self.cur.executemany ("INSERT INTO page (item_id, dtime, updt, data) VALUES (?,?,NULL,?)", pages)
+                if fts:
+                    self.cur.executemany ("INSERT INTO item_fts (rowid, item, data) VALUES (?,?,?)", text)
+                    for t in fts:
+                        self.cur.execute (t)
+                self.con.commit()
+            # A file that is not UTF-8 fails as it is read, part way through a batch: that batch is rolled back too.
+            except (sql.Error, csv.Error, UnicodeDecodeError, OSError) as em:
+                print ("*** Error: {} '{}'".format(src, em))
+                self.con.rollback()
+                break
+            if items:
+                if first_id is None:
+                    first_id = items[0][0]
+                last_id = items[-1][0]
+            if len(items) < IMPORT_ROWS:
+                break
+        if fh is not sys.stdin:
+            fh.close()
+        if first_id is None:
+            print ("No items imported from {} ({} skipped)...".format (src, skipped))
+            return False
+        print ("Imported {} items from {}: ids {}-{} ({}), {} skipped...".format (
+            last_id - first_id + 1, src, first_id, last_id,
+            ', '.join (['{} {}'.format (counts[k], k) for k in counts]), skipped))
+        return True
 
-    s = """SELECT item_id FROM item WHERE item_type IS 'TODO' AND is_done IS 0"""
-    try:
-        cur.execute(s)
-    except sql.Error as em:
-        print ("*** Error: {} '{}'".format(s, em))
-        cur.close()
-        con.close()
-        return False
-    row = cur.fetchall()
-    for r in row:
-        if r and r[0]:
-            print ("\n")
-            res = do_show_todo (fn, r[0])
-            if res is False:
-                print ("Failed trying to print todo given by item_id {}".format (r[0]))
-
-    cur.close()
-    con.close()
-    return True
- 
-########################################################################################################################
-### flag_todo_done
-########################################################################################################################
-def flag_todo_done (fn: str, id: str) -> bool:
-    """Flag the todo item given by id in jnl file fn as done."""
-    # Open journal file
-    try:
-        con = sql.connect (fn)
-        cur = con.cursor()
-    except sql.Error as em:
-        print ("*** SQLite error opening Journal file: {}".format (em))
-        return False
+    ####################################################################################################################
+    ### do_compact_pages
+    ####################################################################################################################
+    def do_compact_pages (self, codec: str) -> bool:
+        """Recompress every page not stored with codec, COMPACT_PAGES pages per transaction. A page that would not get
+        any smaller is left as it is."""
+        s = """SELECT rowid, codec FROM page WHERE codec IS NOT ? AND data IS NOT NULL ORDER BY rowid"""
+        try:
+            self.cur.execute(s, (codec,))
+        except sql.Error as em:
+            print ("*** Error: {} '{}'".format(s, em))
+            return False
+        rows = self.cur.fetchall()
+        done = 0
+        saved = 0
+        for i in range (0, len(rows), COMPACT_PAGES):
+            try:
+                self.begin ()
+                for rowid, old in rows[i:i + COMPACT_PAGES]:
+                    n = self.compact_page (rowid, old, codec)
+                    if n:
+                        done += 1
+                        saved += n
+                self.con.commit ()
+            except (sql.Error,) + CODEC_ERRORS as em:
+                print ("*** Error: {} '{}'".format(self.fn, em))
+                self.con.rollback ()
+                return False
+        print ("Compacted {} of {} pages with {}, {} bytes saved...".format (done, len(rows), codec, saved))
+        return True
 
-    # Verify it is a sqlite journal file.
-    try:
-        cur.execute('SELECT * FROM item WHERE item_type = "NONE"')
-    except sql.Error as em:
-        print ("***Error: {} '{}'".format(args.filename, em))
-        cur.close()
-        con.close()
-        return False
+    ####################################################################################################################
+    ### compact_page
+    ####################################################################################################################
+    def compact_page (self, rowid: int, old: str, codec: str) -> int:
+        """Recompress the page in rowid, stored with codec old, to codec. Returns the bytes saved, 0 if it was left
+        alone. The text is unchanged, so item_fts needs no update."""
+        with self.con.blobopen ('page', 'data', rowid, readonly=True) as blob:
+            stored = len(blob)
+        with self.compress_chunks (self.page_chunks (rowid, old), codec) as spool:
+            n = spool.tell ()
+            if n >= stored:
+                return 0
+            spool.seek (0)
+            self.cur.execute ("UPDATE page SET data = zeroblob(?), codec = ? WHERE rowid = ?", (n, codec, rowid))
+            self.fill_blob (rowid, spool, n)
+        return stored - n
+
+    ####################################################################################################################
+    ### do_epoch_timestamps
+    ####################################################################################################################
+    def do_epoch_timestamps (self) -> bool:
+        """Convert every timestamp column in the journal to integer UTC epoch seconds, in place."""
+        if self.epoch:
+            print ("Journal {} already stores epoch timestamps - nothing changed.".format (self.fn))
+            return True
+        # Indexes and triggers go away with their tables. Keep their SQL to put them back, and drop the triggers up
+        # front so none of them refers to a table that is half way through being rebuilt.
+        names = "'" + "','".join ([t[0] for t in EPOCH_TABLES]) + "'"
+        s = """SELECT type, name, sql FROM sqlite_master
+               WHERE type IN ('index','trigger') AND sql IS NOT NULL AND tbl_name IN ({})
+               ORDER BY type""".format (names)
+        try:
+            self.cur.execute(s)
+        except sql.Error as em:
+            print ("*** Error: {} '{}'".format(s, em))
+            return False
+        keep = self.cur.fetchall()
+        s = "BEGIN IMMEDIATE TRANSACTION;\n"
+        for r in keep:
+            if r[0] == 'trigger':
+                s += "DROP TRIGGER {};\n".format (r[1])
+        for name, ddl, cols in EPOCH_TABLES:
+            sel = ', '.join ([epoch_sql (c) if c in EPOCH_COLUMNS else c for c in cols])
+            s += ddl + ";\n"
+            s += "INSERT INTO {0}_new SELECT {1} FROM {0};\n".format (name, sel)
+            if name == 'item':
+                # Keep the AUTOINCREMENT high-water mark, which can be above MAX(item_id) after an --rm.
+                s += "UPDATE sqlite_sequence SET seq = (SELECT seq FROM sqlite_sequence WHERE name = 'item') WHERE name = 'item_new';\n"
+            s += "DROP TABLE {0};\nALTER TABLE {0}_new RENAME TO {0};\n".format (name)
+        for r in keep:
+            s += r[2] + ";\n"
+        s += "COMMIT;"
+        try:
+            self.cur.executescript(s)
+        except sql.Error as em:
+            print ("*** Error: converting {} to epoch timestamps '{}'".format(self.fn, em))
+            self.con.rollback()
+            return False
+        self.epoch = True
+        # The old tables leave their pages on the free list. Give them back so the file actually shrinks.
+        try:
+            self.cur.execute ('VACUUM')
+        except sql.Error as em:
+            print ("*** Error: VACUUM '{}'".format(em))
+        print ("Converted {} to epoch timestamps...".format (self.fn))
+        return True
 
-    # Good sqlite file. Proceed.
-    s = """BEGIN TRANSACTION; UPDATE item SET is_done = 1, updt = datetime('now','localtime') WHERE item_id = {}; COMMIT;""".format(id)
-    try:
-        cur.executescript(s)
-    except sql.Error as em:
-        print ("*** Error: {} '{}'".format(s, em))
-        cur.close()
-        con.close()
-        return False
+    ####################################################################################################################
+    ### do_search
+    ####################################################################################################################
+    def do_search (self, q: str, item_type: str = None, window: tuple = (None, None), limit: int = None) -> bool:
+        """Full-text search of items and pages, best matches first."""
+        where = ""
+        params = [q]
+        if item_type:
+            where += " AND item.item_type = ?"
+            params.append (item_type)
+        w, wp = self.window_sql (window, 'item.dtime')
+        where += w
+        params += wp
+        lim = ""
+        if limit is not None:
+            lim = " LIMIT ?"
+            params.append (int(limit))
+        # Item text counts double against page text in the ranking.
+        s = """SELECT item.item_id, item.item_type, item.dtime, item.updt, item.is_pg, item.is_done,
+                      highlight(item_fts, 0, '«', '»'), snippet(item_fts, 1, '«', '»', '...', 16)
+               FROM item_fts JOIN item ON item.item_id = item_fts.rowid
+               WHERE item_fts MATCH ?{}
+               ORDER BY bm25(item_fts, 2.0, 1.0){}""".format (where, lim)
+        try:
+            self.cur.execute(s, params)
+        except sql.Error as em:
+            if 'no such table' in str(em):
+                print ("*** Error: {} has no search index (SQLite was built without FTS5)".format (self.fn))
+            else:
+                print ("*** Error: search '{}' '{}'".format(q, em))
+            return False
+        # 0 = item_id, 1 = item_type, 2 = dtime, 3 = updt, 4 = is_pg, 5 = is_done, 6 = item, 7 = page snippet
+        n = 0
+        for r in self.cur:
+            print (fmt_item (r))
+            if '«' in r[7]:
+                print ("        {}".format (' '.join (r[7].split())))
+            n += 1
+        if n == 0:
+            print (" *** No items match '{}' *** ".format (q))
+        return True
 
-    cur.close()
-    con.close()
-    return True
+    ####################################################################################################################
+    ### flag_todo_done
+    ####################################################################################################################
+    def flag_todo_done (self, id: str) -> bool:
+        """Flag the todo item given by id as done."""
+        s = """UPDATE item SET is_done = 1, updt = ? WHERE item_id = ?"""
+        try:
+            self.cur.execute(s, (self.ts_value (), id))
+        except sql.Error as em:
+            print ("*** Error: {} '{}'".format(s, em))
+            return False
+        if self.cur.rowcount != 1:
+            print ("*** Error: no item with item_id {}".format (id))
+            return False
+        return True
 
 ###
 ########################################################################################################################
@@ -1900,7 +2505,15 @@ def flag_todo_done (fn: str, id: str) -> bool:
 ########################################################################################################################
 
 ### Grab a quick snapshot of the command-line, pythonically
-cmd = " ".join(sys.argv[:])
+cmd = shlex.join (sys.argv)
+
+########################################################################################################################
+### stamp_line
+########################################################################################################################
+def stamp_line (args: argparse.Namespace, *opts) -> str:
+    """The cmd_line stamp for a command: the program, the journal and opts, each quoted so shlex reads them back as
+    they were given."""
+    return shlex.join ([sys.argv[0], args.filename] + [str(o) for o in opts])
 
 class SmartFormatter(argparse.HelpFormatter):
     def _split_lines(self, text: str, width: int) -> list[str]:
@@ -1928,375 +2541,1151 @@ class SmartFormatter(argparse.HelpFormatter):
     def _fill_text(self, text: str, width: int, indent: str) -> str:
         return '\n'.join(indent + line for line in self._split_lines(text, width - len(indent)))
 
-parser = argparse.ArgumentParser(
-    prog="jnl",
-#    formatter_class=argparse.RawDescriptionHelpFormatter,
-    formatter_class=SmartFormatter,
-    description=main_help_description)
-
-parser.add_argument(
-    'filename',
-    type = str,
-    help="The journal file name.",
-    metavar="FILENAME")
-
-parser.add_argument (
-    '-a',
-    '--add',
-    action="store_true",
-    dest="is_add",
-    help = "Add a log or todo item")
-
-# parser.add_argument (
-#     '--cancel',
-#     action="store_true",
-#     dest="is_cancel",
-#     help = "Flag a todo item given by id as cancelled")
-
-# parser.add_argument (
-#     '--delegate',
-#     action="store_true",
-#     dest="is_delegate",
-#     help = "Flag a todo item given by id as delegated")
-
-parser.add_argument (
-    '--done',
-    action="store_true",
-    dest="is_done",
-    help = "Flag a todo item given by id as done")
-
-parser.add_argument (
-    '--dt',
-    dest='dt',
-    help="Change the create date for an item with current time",
-    metavar="DT")
-
-parser.add_argument (
-    '--tstmp',
-    dest='tstmp',
-    help="Change the create date for an item with  updated time",
-    metavar="TSTMP")
-
-parser.add_argument (
-    '--edit',
-    action="store_true",
-    dest="is_edit",
-    help = "Edit a todo, log, note, idea or quot item")
-
-parser.add_argument (
-    '--file',
-    dest='file',
-    help="Get a file name from the user",
-    metavar="FILE")
-
-parser.add_argument (
-    '-i',
-    '--idea',
-    dest='idea',
-    help="Add an idea item to the journal",
-    metavar="IDEA")
-
-parser.add_argument (
-    '--id',
-    dest='id',
-    help="Get an item id from the user",
-    metavar="ID")
-
-parser.add_argument (
-    '--item',
-    dest='item',
-    help="Get an item from the user for edit",
-    metavar="ITEM")
-
-parser.add_argument (
-    '-l',
-    '--log',
-    dest='log',
-    help="Add a log item to the journal",
-    metavar="LOG")
-
-parser.add_argument (
-    '--ls',
-    action="store_true",
-    dest="is_ls",
-    help = "List all items")
-
-parser.add_argument (
-    '--all',
-    action="store_true",
-    dest="is_all",
-    help = "List all items by date - works only with --ls")
-
-parser.add_argument (
-    '-n',
-    '--note',
-    dest='note',
-    help="Add a note item to the journal",
-    metavar="NOTE")
-
-parser.add_argument (
-    '--pg',
-    action="store_true",
-    dest="is_pg",
-    help = "Add a page to an item")
-
-parser.add_argument (
-    '-q',
-    '--quot',
-    dest='quot',
-    help="Add a quote to the journal",
-    metavar="QUOT")
-
-parser.add_argument (
-    '--show_pg',
-    action="store_true",
-    dest="is_show_pg",
-    help = "Print an item and its page (if it has one)")
-
-parser.add_argument (
-    '--show_todo',
-    action="store_true",
-    dest="is_show_todo",
-    help="Print an open todo and its page on the screen")
-
-parser.add_argument (
-    '--show_all_todos',
-    action="store_true",
-    dest="is_show_all_todos",
-    help="Print all open todos/pages on the screen")
-
-parser.add_argument (
-    '--dump',
-    action="store_true",
-    dest="is_dump",
-    help="Print all items and pages on the screen")
-
-parser.add_argument (
-    '--dump_cmd_line',
-    action="store_true",
-    dest="is_dump_cmd_line",
-    help="Dump all commands executed to the screen")
-
-# parser.add_argument (
-#     '--soon',
-#     action="store_true",
-#     dest="is_soon",
-#     help = "Flag a todo item given by id as soon => high priority")
-
-# parser.add_argument (
-#     '--start',
-#     action="store_true",
-#     dest="is_start",
-#     help = "Flag a todo item given by id as started")
-
-parser.add_argument (
-    '-t',
-    '--todo',
-    dest='todo',
-    help="Add a todo item to the journal",
-    metavar="TODO")
-
-parser.add_argument (
-    '--rm',
-    action="store_true",
-    dest='is_rm',
-    help="Move an item to the archive table")
-
-parser.add_argument (
-    '--recent',
-    action="store_true",
-    dest='is_recent',
-    help="Show only the last five log,idea,note,quot items and the last five open todos")
-
-cmd1 = None
-args = parser.parse_args()
-
-if not args.filename:
-    print ("***Error: The name of the journal file is required.")
-    sys.exit(-1)
-if not os.path.isfile(args.filename):
-    # Create the file
-    if not createJournalFile(args.filename):
-        sys.exit(1)
-    else:
-        print ("Created journal file {}".format (args.filename))
-        cmd1 = cmd
-
-if args.is_add and args.log:
-    cmd1 = '{} {} --add --log "{}"'.format (sys.argv[0], args.filename, args.log)
-    ok = do_log(args.filename, args.log)
-    if ok is False:
-        print ('*** Error in --add --log "{}"'.format (args.log))
-    else:
-        print ("LOG added: {}...".format (ok))
-
-if args.is_done:
-    if not args.id:
-        print ("*** Error: you must include --id <item_id> with a --done option.")
-        sys.exit(3)
-    cmd1 = '{} {} --id {} --done'.format(sys.argv[0], args.filename, args.id)
-    ok = flag_todo_done(args.filename, args.id)
-    if ok:
-        print ("Set item {} to done...".format (args.id))
-
-if args.dt:
-    if not args.id:
-        print ("*** Error: you must include --id <item_id> with a --dt option.")
-        sys.exit(3)
-    dt = fixup_date (args.dt)
-    cmd1 = '{} {} --id {} --dt "{}"'.format (sys.argv[0],args.filename,args.id,dt)
-    ok = do_create_date (args.filename, args.id, dt)
-
-if args.tstmp:
-    if not args.id:
-        print ("*** Error: you must include --id <item_id> with a --tstmp option.")
-        sys.exit(3)
-    dt = change_date (args.tstmp)
-    cmd1 = '{} {} --id {} --tstmp "{}"'.format (sys.argv[0],args.filename,args.id,dt)
-    ok = do_create_date (args.filename, args.id, dt)
-
-if args.is_edit:
-    if not args.id:
-        print ("*** Error: you must include --id <item_id> with an --edit option.")
-        sys.exit(3)
-    if not args.item:
-        print ("*** Error: you must include --item <replacement item> with an --edit option.")
-        sys.exit(3)
-    cmd1 = '{} {} --id {} --item {} --edit'.format (sys.argv[0], args.filename, args.id, args.item)
-    ok = do_edit (args.filename, args.id, args.item)
-    if ok:
-        print ("Edited item from item_id {} with '{}'...".format(args.id, args.item))
-
-if args.is_ls:
-    if args.is_add:
-        print ("***Error: cannot add while doing an --ls")
-        sys.exit(3)
-    if args.is_all:
-        ok = do_ls_all (args.filename)
-    else:
-        ok = do_ls(args.filename)
-    if ok:
-        sys.exit(0)
-    else:
-        sys.exit(1)
-
-if args.is_recent:
-    if args.is_add:
-        print ("***Error: cannot add while doing a --recent")
-        sys.exit(3)
-    ok = do_recent (args.filename)
-    if ok:
-        sys.exit(0)
-    else:
-        sys.exit(1)
-
-if args.todo and args.log:
-    print ("*** Error: command-line: Can't provide todo and log on the same command")
-    sys.exit(2)
-
-if args.log and not args.is_add:
-    print ("***Warning: You need --add with --log to add a log. Nothing changed.")
-
-if args.is_add and args.note:
-    cmd1 = '{} {} --add --note "{}"'.format (sys.argv[0], args.filename, args.note)
-    ok = do_note(args.filename, args.note)
-    if ok is False:
-        print ('*** Error in --add --note "{}"'.format (args.note))
-    else:
-        print ("NOTE added: {}...".format (ok))
-
-if args.note and not args.is_add:
-    print ("***Warning: You need --add with --note to add a note. Nothing changed.")
-
-if args.is_add and args.idea:
-    cmd1 = '{} {} --add --idea "{}"'.format (sys.argv[0], args.filename, args.idea)
-    ok = do_idea(args.filename, args.idea)
+########################################################################################################################
+### build_parser
+########################################################################################################################
+def build_parser () -> argparse.ArgumentParser:
+    """Build the command-line parser. --batch reuses it for every line of its input."""
+    parser = argparse.ArgumentParser(
+        prog="jnl",
+    #    formatter_class=argparse.RawDescriptionHelpFormatter,
+        formatter_class=SmartFormatter,
+        description=main_help_description)
+
+    parser.add_argument(
+        'filename',
+        type = str,
+        help="The journal file name.",
+        metavar="FILENAME")
+
+    parser.add_argument (
+        '-a',
+        '--add',
+        action="store_true",
+        dest="is_add",
+        help = "Add a log or todo item")
+
+    # parser.add_argument (
+    #     '--cancel',
+    #     action="store_true",
+    #     dest="is_cancel",
+    #     help = "Flag a todo item given by id as cancelled")
+
+    # parser.add_argument (
+    #     '--delegate',
+    #     action="store_true",
+    #     dest="is_delegate",
+    #     help = "Flag a todo item given by id as delegated")
+
+    parser.add_argument (
+        '--done',
+        action="store_true",
+        dest="is_done",
+        help = "Flag a todo item given by id as done")
+
+    parser.add_argument (
+        '--dt',
+        dest='dt',
+        help="Change the create date for an item with current time",
+        metavar="DT")
+
+    parser.add_argument (
+        '--tstmp',
+        dest='tstmp',
+        help="Change the create date for an item with  updated time",
+        metavar="TSTMP")
+
+    parser.add_argument (
+        '--edit',
+        action="store_true",
+        dest="is_edit",
+        help = "Edit a todo, log, note, idea or quot item")
+
+    parser.add_argument (
+        '--file',
+        dest='file',
+        help="Get a file name from the user",
+        metavar="FILE")
+
+    parser.add_argument (
+        '-b',
+        '--bvs',
+        dest='bvs',
+        help="Add a Bible verse item to the journal",
+        metavar="B_VS")
+
+    parser.add_argument (
+        '-i',
+        '--idea',
+        dest='idea',
+        help="Add an idea item to the journal",
+        metavar="IDEA")
+
+    parser.add_argument (
+        '--id',
+        dest='id',
+        help="Get an item id from the user",
+        metavar="ID")
+
+    parser.add_argument (
+        '--item',
+        dest='item',
+        help="Get an item from the user for edit",
+        metavar="ITEM")
+
+    parser.add_argument (
+        '-l',
+        '--log',
+        dest='log',
+        help="Add a log item to the journal",
+        metavar="LOG")
+
+    parser.add_argument (
+        '--ls',
+        action="store_true",
+        dest="is_ls",
+        help = "List all items")
+
+    parser.add_argument (
+        '--all',
+        action="store_true",
+        dest="is_all",
+        help = "List all items by date - works only with --ls")
+
+    parser.add_argument (
+        '-n',
+        '--note',
+        dest='note',
+        help="Add a note item to the journal",
+        metavar="NOTE")
+
+    parser.add_argument (
+        '--pg',
+        action="store_true",
+        dest="is_pg",
+        help = "Add a page to an item")
+
+    parser.add_argument (
+        '-q',
+        '--quot',
+        dest='quot',
+        help="Add a quote to the journal",
+        metavar="QUOT")
+
+    parser.add_argument (
+        '--compress',
+        choices=sorted (PAGE_CODECS),
+        dest='compress',
+        help="Store the --pg page compressed with CODEC; with --compact_pages, the codec to recompress to (default zlib)",
+        metavar="CODEC")
+
+    parser.add_argument (
+        '--compact_pages',
+        action="store_true",
+        dest="is_compact",
+        help="Recompress the pages already in the journal (see --compress)")
+
+    parser.add_argument (
+        '--max_page',
+        type=int,
+        dest='max_page',
+        help="Refuse a --pg file larger than MB megabytes",
+        metavar="MB")
+
+    parser.add_argument (
+        '--show_pg',
+        action="store_true",
+        dest="is_show_pg",
+        help = "Print an item and its page (if it has one)")
+
+    parser.add_argument (
+        '--pg_history',
+        dest='pg_history',
+        help="List the saved revisions of the page of item ID",
+        metavar="ID")
+
+    parser.add_argument (
+        '--pg_at',
+        nargs=2,
+        dest='pg_at',
+        help="Print the page of item ID as it was at DATETIME ('YYYY-MM-DD HH:MM:SS', or 'YYYY-MM-DD' for the end of that day)",
+        metavar=("ID", "DATETIME"))
+
+    parser.add_argument (
+        '--show_todo',
+        action="store_true",
+        dest="is_show_todo",
+        help="Print an open todo and its page on the screen")
+
+    parser.add_argument (
+        '--show_all_todos',
+        action="store_true",
+        dest="is_show_all_todos",
+        help="Print all open todos/pages on the screen")
+
+    parser.add_argument (
+        '--from_id',
+        type=int,
+        dest='from_id',
+        help="Only show items with an item_id of at least ID - works with --show_all_todos",
+        metavar="ID")
+
+    parser.add_argument (
+        '--to_id',
+        type=int,
+        dest='to_id',
+        help="Only show items with an item_id of at most ID - works with --show_all_todos",
+        metavar="ID")
+
+    parser.add_argument (
+        '--limit',
+        type=int,
+        dest='limit',
+        help="Show at most N items - works with --ls (per section), --search and --show_all_todos",
+        metavar="N")
+
+    parser.add_argument (
+        '--after_id',
+        type=int,
+        dest='after_id',
+        help="Page --ls: start after the item given by ID in the listing order",
+        metavar="ID")
+
+    parser.add_argument (
+        '--before',
+        dest='before',
+        help="Page --ls: only items created before DATETIME; with --limit, the last N of them",
+        metavar="DATETIME")
+
+    parser.add_argument (
+        '--search',
+        dest='search',
+        help="Full-text search items and pages, best matches first (SQLite FTS5 query syntax)",
+        metavar="QUERY")
+
+    parser.add_argument (
+        '--type',
+        type=str.upper,
+        choices=['TODO','LOG','NOTE','IDEA','QUOT','B_VS'],
+        dest='item_type',
+        help="Only items of this type - works with --search",
+        metavar="TYPE")
+
+    parser.add_argument (
+        '--since',
+        dest='since',
+        help="Only items created on or after DATE ('YYYY-MM-DD' or 'YYYY-MM-DD HH:MM:SS') - works with the listing, dump and search commands",
+        metavar="DATE")
+
+    parser.add_argument (
+        '--until',
+        dest='until',
+        help="Only items created on or before DATE - works with the listing, dump and search commands",
+        metavar="DATE")
+
+    parser.add_argument (
+        '--on',
+        dest='on',
+        help="Only items created on the day DATE ('YYYY-MM-DD') - works with the listing, dump and search commands",
+        metavar="DATE")
+
+    parser.add_argument (
+        '--import',
+        dest='import_file',
+        help="Bulk load items from a JSONL or CSV file ('-' reads stdin). Fields: type, text, dtime, updt, done, page",
+        metavar="FILE")
+
+    parser.add_argument (
+        '--batch',
+        dest='batch',
+        help="Run each line of FILE ('-' reads stdin) as a jnl command against this journal, e.g. --add --log \"text\"",
+        metavar="FILE")
+
+    parser.add_argument (
+        '--single_transaction',
+        action="store_true",
+        dest="single_transaction",
+        help="Run all --batch commands in one transaction - works only with --batch")
+
+    parser.add_argument (
+        '--shell',
+        action="store_true",
+        dest="shell",
+        help="Interactive prompt on the journal: add log TEXT, ls, done ID, show_pg ID ... (help lists them)")
+
+    parser.add_argument (
+        '--serve',
+        action="store_true",
+        dest="serve",
+        help="Keep the journal open and run commands sent by jnlc.py over a Unix socket (FILE.sock)")
+
+    parser.add_argument (
+        '--socket',
+        dest='socket',
+        help="Socket for --serve, instead of FILE.sock",
+        metavar="PATH")
+
+    parser.add_argument (
+        '--busy_timeout',
+        type=int,
+        default=BUSY_TIMEOUT,
+        dest='busy_timeout',
+        help="Milliseconds to wait for another jnl that is writing to the journal (default {})".format (BUSY_TIMEOUT),
+        metavar="MS")
+
+    parser.add_argument (
+        '--synchronous',
+        type=str.upper,
+        choices=['FULL', 'NORMAL'],
+        dest='synchronous',
+        help="NORMAL: one fsync per checkpoint instead of per command. Faster on slow disks; a power cut can lose the last few commands, never the journal")
+
+    parser.add_argument (
+        '--replay',
+        dest='replay',
+        help="Rebuild this (new) journal by re-running the command history of SOURCE, with the original ids and times",
+        metavar="SOURCE")
+
+    parser.add_argument (
+        '--epoch_timestamps',
+        action="store_true",
+        dest="is_epoch",
+        help="Convert the journal to store timestamps as compact integer UTC epoch seconds (shown in local time)")
+
+    parser.add_argument (
+        '--dump',
+        action="store_true",
+        dest="is_dump",
+        help="Print all items and pages on the screen")
+
+    parser.add_argument (
+        '--dump_cmd_line',
+        action="store_true",
+        dest="is_dump_cmd_line",
+        help="Dump all commands executed to the screen")
+
+    # parser.add_argument (
+    #     '--soon',
+    #     action="store_true",
+    #     dest="is_soon",
+    #     help = "Flag a todo item given by id as soon => high priority")
+
+    # parser.add_argument (
+    #     '--start',
+    #     action="store_true",
+    #     dest="is_start",
+    #     help = "Flag a todo item given by id as started")
+
+    parser.add_argument (
+        '-t',
+        '--todo',
+        dest='todo',
+        help="Add a todo item to the journal",
+        metavar="TODO")
+
+    parser.add_argument (
+        '--rm',
+        action="store_true",
+        dest='is_rm',
+        help="Move an item to the archive table")
+
+    parser.add_argument (
+        '--recent',
+        action="store_true",
+        dest='is_recent',
+        help="Show only the last five log,idea,note,quot items and the last five open todos")
+
+    parser.add_argument (
+        '--count',
+        type=int,
+        default=5,
+        dest='count',
+        help="Number of items of each kind shown by --recent (default 5)",
+        metavar="N")
+
+    return parser
+
+########################################################################################################################
+### run_command
+########################################################################################################################
+def run_command (jnl: Journal, args: argparse.Namespace, cmd1: str = None) -> tuple:
+    """Run the command in args against an open journal. Returns (ok, cmd1), where cmd1 is the command-line to stamp
+    into cmd_line, or None for the read-only listings, which are not stamped. ok is False when the command failed."""
+    ok = True
+    # --since/--until/--on date range shared by the listing, dump and search commands.
+    window = date_window (args.since, args.until, args.on)
+
+    # --add: one item for each add option given, added together in ADD_OPTIONS order.
+    adds = [(k, t, getattr (args, k)) for k, t in ADD_OPTIONS if getattr (args, k)]
+    if args.todo and args.log:
+        print ("*** Error: command-line: Can't provide todo and log on the same command")
+        sys.exit(2)
+
+    if args.is_add and adds:
+        opts = ['--add']
+        for k, t, text in adds:
+            opts += ['--' + k, text]
+        cmd1 = stamp_line (args, *opts)
+        ids = jnl.add_items ([(t, text) for k, t, text in adds])
+        if ids is False:
+            for k, t, text in adds:
+                print ('*** Error in --add --{} "{}"'.format (k, text))
+            ok = False
+        else:
+            for (k, t, text), id in zip (adds, ids):
+                print ("{} added: {}...".format (t, id))
+            ok = ids[-1]
+
+    if adds and not args.is_add:
+        for k, t, text in adds:
+            print ("***Warning: You need --add with --{} to add a {} item. Nothing changed.".format (k, t))
+
+    if args.is_done:
+        if not args.id:
+            print ("*** Error: you must include --id <item_id> with a --done option.")
+            sys.exit(3)
+        cmd1 = stamp_line (args, '--id', args.id, '--done')
+        ok = jnl.flag_todo_done (args.id)
+        if ok:
+            print ("Set item {} to done...".format (args.id))
+
+    if args.dt:
+        if not args.id:
+            print ("*** Error: you must include --id <item_id> with a --dt option.")
+            sys.exit(3)
+        dt = fixup_date (args.dt)
+        cmd1 = stamp_line (args, '--id', args.id, '--dt', dt)
+        ok = jnl.do_create_date (args.id, dt)
+
+    if args.tstmp:
+        if not args.id:
+            print ("*** Error: you must include --id <item_id> with a --tstmp option.")
+            sys.exit(3)
+        dt = change_date (args.tstmp)
+        cmd1 = stamp_line (args, '--id', args.id, '--tstmp', dt)
+        ok = jnl.do_create_date (args.id, dt)
+
+    if args.is_edit:
+        if not args.id:
+            print ("*** Error: you must include --id <item_id> with an --edit option.")
+            sys.exit(3)
+        if not args.item:
+            print ("*** Error: you must include --item <replacement item> with an --edit option.")
+            sys.exit(3)
+        cmd1 = stamp_line (args, '--id', args.id, '--item', args.item, '--edit')
+        ok = jnl.do_edit (args.id, args.item)
+        if ok:
+            print ("Edited item from item_id {} with '{}'...".format(args.id, args.item))
+
+    if args.is_ls:
+        if args.is_add:
+            print ("***Error: cannot add while doing an --ls")
+            sys.exit(3)
+        if args.limit is not None and args.limit < 1:
+            print ("*** Error: --limit must be at least 1")
+            sys.exit(3)
+        before = None
+        if args.before:
+            before = check_datetime (args.before)
+        if args.is_all:
+            return jnl.do_ls_all (args.limit, args.after_id, before, window), None
+        return jnl.do_ls (args.limit, args.after_id, before, window), None
+
+    if args.is_recent:
+        if args.is_add:
+            print ("***Error: cannot add while doing a --recent")
+            sys.exit(3)
+        if args.count < 1:
+            print ("*** Error: --count must be at least 1")
+            sys.exit(3)
+        return jnl.do_recent (args.count, window), None
+
+    if args.search:
+        if args.is_add:
+            print ("***Error: cannot add while doing a --search")
+            sys.exit(3)
+        return jnl.do_search (args.search, args.item_type, window, args.limit), None
+
+    if args.is_pg:
+        if not args.file:
+            print ("*** Error: you must include --file <name> with a --pg option.")
+            sys.exit(3)
+        if not args.id:
+            print ("*** Error: you must include --id <item_id> with a --pg option.")
+            sys.exit(3)
+        opts = ['--id', args.id, '--pg', '--file', args.file]
+        if args.compress:
+            opts += ['--compress', args.compress]
+        cmd1 = stamp_line (args, *opts)
+        ok = jnl.do_pg (args.id, args.file, args.max_page, args.compress)
+        if ok:
+            print ("Added pg from {} to item_id {}...".format(args.file, args.id))
+
+    if args.is_show_pg:
+        if not args.id:
+            print ("*** Error: you must include --id <item_id> with a --show_pg option.")
+            sys.exit(3)
+        cmd1 = stamp_line (args, '--id', args.id, '--show_pg')
+        ok = jnl.do_show_pg (args.id)
+
+    if args.pg_history:
+        cmd1 = stamp_line (args, '--pg_history', args.pg_history)
+        ok = jnl.do_pg_history (args.pg_history)
+
+    if args.pg_at:
+        at = check_datetime (args.pg_at[1])
+        # A bare date takes in the whole of that day, as it does for --until.
+        if len(args.pg_at[1].strip()) == 10:
+            at = at[:10] + ' 23:59:59'
+        cmd1 = stamp_line (args, '--pg_at', args.pg_at[0], args.pg_at[1])
+        ok = jnl.do_pg_at (args.pg_at[0], at)
+
+    if args.is_show_todo:
+        if not args.id:
+            print ("*** Error: you must include --id <item_id> with a --show_todo option.")
+            sys.exit(3)
+        cmd1 = stamp_line (args, '--id', args.id, '--show_todo')
+        ok = jnl.do_show_todo (args.id)
+
+    if args.is_show_all_todos:
+        opts = ['--show_all_todos']
+        if args.from_id is not None:
+            opts += ['--from_id', args.from_id]
+        if args.to_id is not None:
+            opts += ['--to_id', args.to_id]
+        if args.limit is not None:
+            opts += ['--limit', args.limit]
+        cmd1 = stamp_line (args, *opts)
+        ok = jnl.do_show_all_todos (args.from_id, args.to_id, args.limit, window)
+
+    if args.is_dump:
+        cmd1 = stamp_line (args, '--dump')
+        ok = jnl.do_dump (window)
+
+    if args.is_dump_cmd_line:
+        cmd1 = stamp_line (args, '--dump_cmd_line')
+        ok = jnl.do_dump_cmd_line (window)
+
+    if args.import_file:
+        cmd1 = stamp_line (args, '--import', args.import_file)
+        ok = jnl.do_import (args.import_file)
+
+    if args.is_epoch:
+        cmd1 = stamp_line (args, '--epoch_timestamps')
+        ok = jnl.do_epoch_timestamps ()
+
+    if args.is_compact:
+        codec = args.compress or 'zlib'
+        cmd1 = stamp_line (args, '--compact_pages', '--compress', codec)
+        ok = jnl.do_compact_pages (codec)
+
+    if args.is_rm:
+        if not args.id:
+            print ("*** Error: you must include --id <item_id> with a --rm option.")
+            sys.exit(3)
+        cmd1 = stamp_line (args, '--id', args.id, '--rm')
+        ok = jnl.do_rm (args.id)
+
+    if cmd1 is None:
+        return jnl.do_recent (args.count, window), None
+    return ok, cmd1
+
+########################################################################################################################
+### run_argv
+########################################################################################################################
+def run_argv (jnl: Journal, parser: argparse.ArgumentParser, fn: str, argv: list, where: str) -> tuple:
+    """Parse the options in argv against the journal fn and run them with run_parsed, for --batch and --shell (named
+    by where). Bad input ends the command, not the caller. Returns (ok, cmd1) like run_command."""
+    try:
+        a = parser.parse_args ([fn] + argv)
+        if a.batch or a.replay or a.shell or a.serve or (jnl.batch and any ([getattr (a, k) for k in OWN_TRANSACTION_OPTIONS])):
+            print ("*** Error: this command cannot be run inside {}".format (where))
+            return False, None
+        return run_parsed (jnl, a)
+    except SystemExit as e:
+        # argparse and the option checks exit on bad input.
+        return e.code in (0, None), None
+    except sql.Error as em:
+        print ("*** Error: '{}'".format (em))
+        return False, None
+
+########################################################################################################################
+### run_parsed
+########################################################################################################################
+def run_parsed (jnl: Journal, a: argparse.Namespace, cmd1: str = None) -> tuple:
+    """Run parsed options and stamp them. A command that writes runs in one transaction together with its cmd_line
+    stamp; one that only reads is stamped after. Inside a caller's transaction (jnl.batch) the stamp is left to the
+    caller. Returns (ok, cmd1) like run_command."""
+    own = [k for k in OWN_TRANSACTION_OPTIONS if getattr (a, k)]
+    if own and (len(own) > 1 or any ([getattr (a, k) for k in WRITE_OPTIONS if k not in own])):
+        print ("*** Error: {} cannot be combined with other changes in one command".format (
+            ' and '.join ([OWN_TRANSACTION_OPTIONS[k] for k in own])))
+        return False, None
+    if jnl.batch:
+        return run_command (jnl, a, cmd1)
+    # --import commits in batches of its own.
+    if any ([getattr (a, k) for k in WRITE_OPTIONS]) and not a.import_file:
+        return run_in_transaction (jnl, a, cmd1)
+    ok, cmd1 = run_command (jnl, a, cmd1)
+    if cmd1 is not None and not jnl.stamp_command (cmd1):
+        print ("*** Error: could not save command in cmd_line table")
+        ok = False
+    return ok, cmd1
+
+########################################################################################################################
+### run_in_transaction
+########################################################################################################################
+def run_in_transaction (jnl: Journal, a: argparse.Namespace, cmd1: str = None) -> tuple:
+    """run_command in one transaction together with the cmd_line stamp: one commit, and all or nothing. A failed
+    command is rolled back and not stamped."""
+    try:
+        jnl.begin ()
+    except sql.Error as em:
+        print ("*** Error: {} '{}'".format(jnl.fn, em))
+        return False, None
+    jnl.batch = True
+    ok = False
+    try:
+        ok, cmd1 = run_command (jnl, a, cmd1)
+        if cmd1 is not None and ok is not False:
+            ok = jnl.stamp_commands ([cmd1])
+    finally:
+        jnl.batch = False
+        if ok is False:
+            jnl.con.rollback()
     if ok is False:
-        print ('*** Error in --add --idea "{}"'.format (args.idea))
-    else:
-        print ("IDEA added: {}...".format (ok))
-
-if args.idea and not args.is_add:
-    print ("***Warning: You need --add with --idea to add an idea. Nothing changed.")
+        return ok, cmd1
+    try:
+        jnl.con.commit()
+    except sql.Error as em:
+        print ("*** Error: {} '{}'".format(jnl.fn, em))
+        jnl.con.rollback()
+        return False, None
+    return ok, cmd1
 
-if args.is_add and args.quot:
-    cmd1 = '{} {} --add --quot "{}"'.format (sys.argv[0], args.filename, args.quot)
-    ok = do_quot(args.filename, args.quot)
-    if ok is False:
-        print ('*** Error in --add --quot "{}"'.format (args.quot))
+########################################################################################################################
+### run_batch
+########################################################################################################################
+def run_batch (jnl: Journal, parser: argparse.ArgumentParser, args: argparse.Namespace) -> bool:
+    """Run each line of the --batch file (or stdin) as a jnl command against the one open journal. Lines hold the
+    options only - the journal is the one named on the command-line. Each line commits on its own, like a separate
+    jnl run; with --single_transaction they all commit together at the end, stamps included. Returns False if any line
+    failed."""
+    if args.batch == '-':
+        f = sys.stdin
     else:
-        print ("QUOT added: {}...".format (ok))
-
-if args.quot and not args.is_add:
-    print ("***Warning: You need --add with --quot to add a quot. Nothing changed.")
+        try:
+            f = open (args.batch, 'r')
+        except OSError as em:
+            print ("*** Error: {} '{}'".format(args.batch, em))
+            return False
+    cmds = []
+    ran = 0
+    failed = 0
+    if args.single_transaction:
+        try:
+            jnl.begin ()
+        except sql.Error as em:
+            print ("*** Error: {} '{}'".format(jnl.fn, em))
+            return False
+        jnl.batch = True
+    for n, line in enumerate (f, 1):
+        line = line.strip()
+        if not line or line.startswith ('#'):
+            continue
+        ran += 1
+        ok = False
+        cmd1 = None
+        if jnl.batch:
+            # A failed line only takes its own changes with it.
+            jnl.cur.execute ('SAVEPOINT batch_line')
+        try:
+            ok, cmd1 = run_argv (jnl, parser, args.filename, shlex.split (line), '--batch')
+        except ValueError as em:
+            print ("*** Error: '{}'".format (em))
+        if ok is False:
+            failed += 1
+            print ("*** Error: {} line {} failed: {}".format (args.batch, n, line))
+            if jnl.batch:
+                jnl.cur.execute ('ROLLBACK TO batch_line')
+        if jnl.batch:
+            jnl.cur.execute ('RELEASE batch_line')
+        # Like run_in_transaction: a failed line is rolled back and not stamped.
+        if cmd1 is not None and jnl.batch and ok is not False:
+            cmds.append (cmd1)
+    if f is not sys.stdin:
+        f.close()
+    if cmds and not jnl.stamp_commands (cmds):
+        print ("*** Error: could not save commands in cmd_line table")
+    if jnl.batch:
+        jnl.batch = False
+        try:
+            jnl.con.commit()
+        except sql.Error as em:
+            print ("*** Error: {} '{}'".format(jnl.fn, em))
+            jnl.con.rollback()
+            return False
+    print ("Ran {} commands from {}, {} failed...".format (ran, args.batch, failed))
+    return failed == 0
+
+########################################################################################################################
+### JnlShell
+########################################################################################################################
+# --shell verbs that act on one item: verb -> (CLI option, which ids tab completion offers).
+SHELL_ID_VERBS = {
+    'done': ('--done', "item_type = 'TODO' AND is_done = 0"),
+    'edit': ('--edit', "item_type IS NOT 'NONE'"),
+    'pg': ('--pg', "item_type IS NOT 'NONE'"),
+    'dt': ('--dt', "item_type IS NOT 'NONE'"),
+    'tstmp': ('--tstmp', "item_type IS NOT 'NONE'"),
+    'rm': ('--rm', "item_type IS NOT 'NONE'"),
+    'show_pg': ('--show_pg', "is_pg"),
+    'show_todo': ('--show_todo', "item_type = 'TODO'"),
+}
+# --shell verbs that are just the CLI option of the same name; the rest of the line is passed on as options.
+SHELL_VERBS = ('ls', 'recent', 'search', 'show_all_todos', 'dump', 'dump_cmd_line')
+
+shell_help = '''
+add log|note|idea|quot|todo|bvs TEXT  add an item (TEXT need not be quoted)
+done ID | rm ID | show_pg ID | show_todo ID
+edit ID TEXT | pg ID FILE | dt ID DATE | tstmp ID DATETIME
+ls [--all] [--limit N] ... | recent [--count N] | search QUERY [--type T]
+show_all_todos | dump | dump_cmd_line
+--any --jnl --options                 run a line of CLI options as they are
+help options                          the CLI options; quit (or ^D) leaves
+'''
 
-if args.is_add and args.todo:
-    # Enter a todo item
-    cmd1 = '{} {} --add --todo "{}"'.format (sys.argv[0], args.filename, args.todo)
-    ok = do_todo (args.filename, args.todo)
-    if ok is False:
-        print ('*** Error in --add --todo "{}"'.format (args.todo))
-    else:
-        print ("TODO added: {}...".format (ok))
+def shell_argv (line: str) -> list:
+    """Turn a --shell line into the CLI options it stands for. Raises ValueError for a line it cannot read."""
+    # The text of add and edit is taken as typed, so it can hold a lone quote. Quotes around all of it are dropped.
+    head = line.split (None, 2)
+    if head[0] in ('add', 'edit') and len(head) == 3:
+        text = head[2].strip()
+        if len(text) > 1 and text[0] == text[-1] and text[0] in '"\'':
+            text = text[1:-1]
+        if head[0] == 'add':
+            if head[1] not in [k for k, t in ADD_OPTIONS]:
+                raise ValueError ("use: add {} TEXT".format ('|'.join ([k for k, t in ADD_OPTIONS])))
+            return ['--add', '--' + head[1], text]
+        return ['--id', head[1], '--edit', '--item', text]
+    words = shlex.split (line)
+    if words[0].startswith ('-'):
+        return words
+    verb, rest = words[0], words[1:]
+    if verb == 'add':
+        raise ValueError ("use: add {} TEXT".format ('|'.join ([k for k, t in ADD_OPTIONS])))
+    if verb in SHELL_ID_VERBS:
+        if not rest:
+            raise ValueError ("use: {} ID ...".format (verb))
+        argv = ['--id', rest[0], SHELL_ID_VERBS[verb][0]]
+        if verb == 'pg':
+            argv += ['--file'] + rest[1:2]
+        elif verb in ('dt', 'tstmp'):
+            argv += [' '.join (rest[1:])]
+        return argv
+    if verb == 'search':
+        return ['--search'] + rest
+    if verb in SHELL_VERBS:
+        return ['--' + verb] + rest
+    raise ValueError ("unknown command '{}' - try help".format (verb))
+
+class JnlShell (cmd_mod.Cmd):
+    """--shell: read jnl commands at a prompt and run them against the one open journal. Each command runs in its
+    own transaction together with its cmd_line stamp, so a write costs one commit."""
+    prompt = 'jnl> '
+
+    def __init__ (self, jnl: Journal, parser: argparse.ArgumentParser, fn: str):
+        super().__init__ ()
+        self.jnl = jnl
+        self.parser = parser
+        self.fn = fn
+        self.intro = "jnl shell on {} - help lists the commands, quit leaves.".format (fn)
+        # Item ids offered by tab completion, per verb. Dropped after every write.
+        self.ids = {}
+
+    def default (self, line: str) -> bool:
+        try:
+            argv = shell_argv (line)
+        except ValueError as em:
+            print ("*** Error: {}".format (em))
+            return False
+        ok, cmd1 = run_argv (self.jnl, self.parser, self.fn, argv, '--shell')
+        if ok is not False and cmd1 is not None:
+            self.ids.clear()
+        return False
+
+    def completenames (self, text: str, *ignored) -> list:
+        verbs = ['add', 'help', 'quit'] + list (SHELL_ID_VERBS) + list (SHELL_VERBS)
+        return [v for v in verbs if v.startswith (text)]
+
+    def completedefault (self, text: str, line: str, begidx: int, endidx: int) -> list:
+        words = line[:begidx].split()
+        if len(words) == 1 and words[0] == 'add':
+            return [k for k, t in ADD_OPTIONS if k.startswith (text)]
+        if len(words) != 1 or words[0] not in SHELL_ID_VERBS:
+            return []
+        verb = words[0]
+        if verb not in self.ids:
+            try:
+                self.jnl.cur.execute ("SELECT item_id FROM item WHERE {} ORDER BY item_id".format (SHELL_ID_VERBS[verb][1]))
+            except sql.Error:
+                return []
+            self.ids[verb] = [str(r[0]) for r in self.jnl.cur.fetchall()]
+        return [i for i in self.ids[verb] if i.startswith (text)]
+
+    def emptyline (self) -> bool:
+        return False
+
+    def do_help (self, arg: str) -> bool:
+        if arg == 'options':
+            self.parser.print_help ()
+        else:
+            print (shell_help)
+        return False
 
-if args.todo and not args.is_add:
-    print ("***Warning: You need --add with --todo to add a todo item. Nothing changed.")
+    def do_quit (self, arg: str) -> bool:
+        return True
 
-if args.is_pg:
-    if not args.file:
-        print ("*** Error: you must include --file <name> with a --pg option.")
-        sys.exit(3)
-    if not args.id:
-        print ("*** Error: you must include --id <item_id> with a --pg option.")
-        sys.exit(3)
-    cmd1 = '{} {} --id {} --pg --file "{}"'.format (sys.argv[0], args.filename, args.id, args.file)
-    ok = do_pg (args.filename, args.id, args.file)
-    if ok:
-        print ("Added pg from {} to item_id {}...".format(args.file, args.id))
-
-if args.is_show_pg:
-    if not args.id:
-        print ("*** Error: you must include --id <item_id> with a --show_pg option.")
-        sys.exit(3)
-    cmd1 = '{} {} --id {} --show_pg'.format (sys.argv[0],args.filename,args.id)
-    ok = do_show_pg (args.filename, args.id)
+    do_exit = do_quit
 
-if args.is_show_todo:
-    if not args.id:
-        print ("*** Error: you must include --id <item_id> with a --show_todo option.")
-        sys.exit(3)
-    cmd1 = '{} {} --id {} --show_todo'.format (sys.argv[0], args.filename, args.id)
-    ok = do_show_todo(args.filename, args.id)
+    def do_EOF (self, arg: str) -> bool:
+        print ()
+        return True
 
-if args.is_show_all_todos:
-    cmd1 = '{} {} --show_all_todos'.format (sys.argv[0], args.filename)
-    ok = do_show_all_todos(args.filename)
+########################################################################################################################
+### run_shell
+########################################################################################################################
+def run_shell (jnl: Journal, parser: argparse.ArgumentParser, args: argparse.Namespace) -> bool:
+    """Run the --shell prompt until quit or end of input. ^C drops the current line, not the shell."""
+    sh = JnlShell (jnl, parser, args.filename)
+    while True:
+        try:
+            sh.cmdloop ()
+            return True
+        except KeyboardInterrupt:
+            print ("^C")
+            sh.intro = ''
+
+########################################################################################################################
+### JnlServer
+########################################################################################################################
+def serve_command (srv: 'JnlServer', argv: list) -> int:
+    """Run one client command line (journal name first) against the served journal. Returns the exit code jnl
+    would have given."""
+    try:
+        with contextlib.redirect_stderr (sys.stdout):
+            a = srv.parser.parse_args (argv)
+    except SystemExit as e:
+        return e.code or 0
+    if os.path.abspath (a.filename) != srv.fn:
+        print ("*** Error: this server has {} open, not {}".format (srv.fn, a.filename))
+        return 1
+    if a.serve or a.shell or a.replay or '-' in (a.batch, a.import_file):
+        print ("*** Error: this command cannot be run through --serve")
+        return 1
+    jnl = srv.jnl
+    if a.batch:
+        return 0 if run_batch (jnl, srv.parser, a) else 1
+    try:
+        ok, cmd1 = run_parsed (jnl, a)
+    except SystemExit as e:
+        return e.code or 0
+    return 0 if ok is not False else 1
+
+class JnlRequestHandler (socketserver.StreamRequestHandler):
+    """One client: a JSON line {"argv": [...], "cwd": "..."} in; the command's output, then NUL and the exit code,
+    back."""
+    # A client that stalls cannot hold up the others for longer than this.
+    timeout = 30
+
+    def handle (self) -> None:
+        srv = self.server
+        try:
+            req = json.loads (self.rfile.readline())
+            argv = [str(a) for a in req['argv']]
+            cwd = req.get ('cwd')
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return
+        out = io.TextIOWrapper (self.wfile, encoding='utf-8', write_through=True)
+        here = os.getcwd()
+        try:
+            # Relative paths (--file, --batch, the journal name) are the client's.
+            if cwd:
+                os.chdir (cwd)
+            with contextlib.redirect_stdout (out):
+                code = serve_command (srv, argv)
+            out.write ('\0{}\n'.format (code))
+        except OSError:
+            # The client went away part way through. Whatever it started is dropped.
+            srv.jnl.batch = False
+            if srv.jnl.con.in_transaction:
+                srv.jnl.con.rollback()
+        finally:
+            os.chdir (here)
+            out.detach()
+
+class JnlServer (socketserver.UnixStreamServer):
+    """--serve: one journal kept open behind a Unix socket. Requests are handled one at a time, which serialises
+    the writes without any SQLite lock contention between clients."""
+    def __init__ (self, path: str, jnl: Journal, parser: argparse.ArgumentParser):
+        self.jnl = jnl
+        self.parser = parser
+        self.fn = os.path.abspath (jnl.fn)
+        super().__init__ (path, JnlRequestHandler)
+
+########################################################################################################################
+### run_serve
+########################################################################################################################
+def run_serve (jnl: Journal, parser: argparse.ArgumentParser, args: argparse.Namespace) -> bool:
+    """Serve the journal on args.socket (FILE.sock by default) until interrupted. jnlc.py is the client."""
+    path = os.path.abspath (args.socket or args.filename + '.sock')
+    if os.path.exists (path):
+        # Refuse to take over a live server; a socket left behind by one that died is removed.
+        try:
+            s = socket.socket (socket.AF_UNIX, socket.SOCK_STREAM)
+            s.connect (path)
+            s.close()
+            print ("*** Error: {} is already being served on {}".format (args.filename, path))
+            return False
+        except OSError:
+            os.unlink (path)
+    try:
+        srv = JnlServer (path, jnl, parser)
+    except OSError as em:
+        print ("*** Error: {} '{}'".format (path, em))
+        return False
+    os.chmod (path, 0o600)
+    signal.signal (signal.SIGTERM, lambda signum, frame: sys.exit (0))
+    print ("Serving {} on {}...".format (args.filename, path))
+    sys.stdout.flush ()
+    try:
+        srv.serve_forever ()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        srv.server_close ()
+        os.unlink (path)
+    return True
 
-if args.is_dump:
-    cmd1 = '{} {} --dump'.format(sys.argv[0], args.filename)
-    ok = do_dump(args.filename)
+########################################################################################################################
+### replay_args
+########################################################################################################################
+def replay_args (parser: argparse.ArgumentParser, fn: str, cmd: str):
+    """Parse a command-line recorded in cmd_line (program and journal name first) against the journal fn. Returns the
+    parsed arguments, or None if the line cannot be parsed."""
+    # Older --edit stamps did not quote the replacement text.
+    m = re.match (r'\S+ \S+ --id (\S+) --item (?!["\'])(.*) --edit$', cmd)
+    if m:
+        return parser.parse_args ([fn, '--id', m.group(1), '--item', m.group(2), '--edit'])
+    try:
+        argv = shlex.split (cmd)[2:]
+        with contextlib.redirect_stderr (io.StringIO()):
+            return parser.parse_args ([fn] + argv)
+    except (ValueError, SystemExit):
+        return None
+
+########################################################################################################################
+### run_replay
+########################################################################################################################
+def run_replay (jnl: Journal, parser: argparse.ArgumentParser, args: argparse.Namespace) -> bool:
+    """Rebuild a new journal from the cmd_line history of the --replay source. Commands that changed the source are
+    re-run in order, each at the time it was stamped, and every new item gets the id it had in the source, so --id
+    references in later commands stay valid. Pages come from the source, since the --pg files may be long gone. All
+    the cmd_line rows are copied across. The work is committed IMPORT_ROWS commands at a time."""
+    try:
+        # Read-only: the source is never migrated or stamped.
+        src = sql.connect ('file:{}?mode=ro'.format (args.replay), uri=True)
+        scur = src.cursor()
+        scur.execute ("SELECT dtime, cmd FROM cmd_line ORDER BY rowid")
+        rows = scur.fetchall()
+        scur.execute ("SELECT item_id, item_type, item FROM item UNION ALL SELECT item_id, item_type, item FROM archive")
+        known = {r[0]: (r[1], r[2]) for r in scur.fetchall()}
+        scur.execute ("SELECT seq FROM sqlite_sequence WHERE name = 'item'")
+        r = scur.fetchone()
+        seq = r[0] if r else 0
+        # Pages of a source from before page compression have no codec.
+        src.create_function ('pg_text', 2, pg_text, deterministic=True)
+        scur.execute ("SELECT 1 FROM pragma_table_info('page') WHERE name = 'codec'")
+        page_sql = PAGE_TEXT_SQL if scur.fetchall() else 'data'
+    except sql.Error as em:
+        print ("*** Error: {} '{}'".format(args.replay, em))
+        return False
+    try:
+        jnl.cur.execute ("SELECT COUNT(*) FROM item WHERE item_id > 1")
+        if jnl.cur.fetchone()[0]:
+            print ("*** Error: {} already has items - --replay needs a new journal".format (args.filename))
+            return False
+        jnl.begin ()
+    except sql.Error as em:
+        print ("*** Error: {} '{}'".format(jnl.fn, em))
+        return False
+    jnl.batch = True
+    # Source ids of each (type, text), in order, for finding an add whose id is not simply the next one.
+    same = {}
+    for i in sorted (known):
+        same.setdefault (known[i], []).append (i)
+    next_id = 2
+    stamps = []
+    ran = 0
+    skipped = 0
+    pending = 0
+    # Set after a line that could not be read: it may have been an add, so the next id is only taken on a text match.
+    resync = False
+    for n, (dt, cmd) in enumerate (rows, 1):
+        ts = jnl.ts_value (fmt_ts (dt)) if dt is not None else None
+        stamps.append ((ts, cmd))
+        if not cmd:
+            continue
+        a = replay_args (parser, args.filename, cmd)
+        if a is None:
+            # Older --add stamps did not escape quotes in the text. A single add is taken as it reads, but only when
+            # that is the text of the item at the next id.
+            m = re.match (r'\S+ \S+ --add --(\w+) "(.*)"$', cmd)
+            if m and known.get (next_id) == (dict (ADD_OPTIONS).get (m.group(1)), m.group(2)):
+                a = parser.parse_args ([args.filename, '--add', '--' + m.group(1), m.group(2)])
+        if a is None:
+            print ("*** Warning: {} cmd_line {}: cannot be read - skipped: {}".format (args.replay, n, cmd))
+            skipped += 1
+            resync = True
+            continue
+        if not any ([getattr (a, k) for k in WRITE_OPTIONS]):
+            continue
+        why = None
+        if a.import_file:
+            why = "--import cannot be replayed"
+        # --dt stamps hold the date with the time it was given.
+        if a.dt and len(a.dt) > 10:
+            a.tstmp, a.dt = a.dt, None
+        # Find the source id of each new item: normally the next id, as long as its type matches. An --edit later on
+        # can change the text, never the type. Only when the type differs (the source add failed, or ids went to an
+        # --import), or a line before could not be read, is it the next item of the same type and text.
+        ids = []
+        for k, t in ADD_OPTIONS:
+            if why or not (a.is_add and getattr (a, k)):
+                continue
+            if known.get (next_id) == (t, getattr (a, k)) or (not resync and known.get (next_id, (None,))[0] == t):
+                id = next_id
+            else:
+                ids_same = same.get ((t, getattr (a, k)), [])
+                j = bisect.bisect_left (ids_same, next_id)
+                id = ids_same[j] if j < len(ids_same) else None
+            if id is None:
+                why = "no matching {} in the source".format (t)
+            else:
+                ids.append (id)
+                next_id = id + 1
+                resync = False
+        page = None
+        if a.is_pg and not why:
+            scur.execute ("""SELECT {} FROM page WHERE item_id = ? UNION ALL
+                             SELECT pg_data FROM archive WHERE item_id = ? AND pg_data IS NOT 'NULL'""".format (page_sql), (a.id, a.id))
+            r = scur.fetchone()
+            if r is None:
+                why = "no page for item {} in the source".format (a.id)
+            else:
+                page = page_text (r[0])
+                a.is_pg = False
+        if why:
+            print ("*** Warning: {} cmd_line {}: {} - skipped: {}".format (args.replay, n, why, cmd))
+            skipped += 1
+            continue
+        jnl.clock = ts
+        jnl.cur.execute ('SAVEPOINT replay_line')
+        out = io.StringIO()
+        ok = True
+        try:
+            if ids:
+                jnl.cur.execute ("UPDATE sqlite_sequence SET seq = ? WHERE name = 'item'", (ids[0] - 1,))
+            with contextlib.redirect_stdout (out):
+                if any ([getattr (a, k) for k in WRITE_OPTIONS]):
+                    ok = run_command (jnl, a)[0]
+                if page is not None and ok is not False:
+                    ok = jnl.do_pg_text (a.id, page)
+        except SystemExit:
+            ok = False
+        except sql.Error as em:
+            out.write ("*** Error: '{}'\n".format (em))
+            ok = False
+        jnl.clock = None
+        if ok is False:
+            jnl.cur.execute ('ROLLBACK TO replay_line')
+            sys.stdout.write (out.getvalue())
+            print ("*** Warning: {} cmd_line {} failed - skipped: {}".format (args.replay, n, cmd))
+            skipped += 1
+        else:
+            ran += 1
+        jnl.cur.execute ('RELEASE replay_line')
+        pending += 1
+        if pending >= IMPORT_ROWS:
+            jnl.cur.executemany ("INSERT INTO cmd_line VALUES (?,?)", stamps)
+            stamps.clear()
+            pending = 0
+            jnl.con.commit()
+            jnl.begin ()
+    src.close()
+    jnl.batch = False
+    try:
+        jnl.cur.executemany ("INSERT INTO cmd_line VALUES (?,?)", stamps)
+        # Leave the sequence where the source left it, so ids freed by --rm are not handed out again.
+        jnl.cur.execute ("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'item'", (seq,))
+        jnl.con.commit()
+    except sql.Error as em:
+        print ("*** Error: {} '{}'".format(jnl.fn, em))
+        jnl.con.rollback()
+        return False
+    print ("Replayed {} of {} commands from {}, {} skipped...".format (ran, len(rows), args.replay, skipped))
+    return True
 
-if args.is_dump_cmd_line:
-    cmd1 = '{} {} --dump_cmd_line'.format(sys.argv[0], args.filename)
-    ok = do_dump_cmd_line(args.filename)
+########################################################################################################################
+### main
+########################################################################################################################
+def main () -> int:
+    parser = build_parser ()
+    cmd1 = None
+    args = parser.parse_args()
 
-if args.is_rm:
-    if not args.id:
-        print ("*** Error: you must include --id <item_id> with a --rm option.")
-        sys.exit(3)
-    cmd1 = '{} {} --id {} --rm'.format (sys.argv[0], args.filename, args.id)
-    ok = do_rm(args.filename, args.id)
+    if not args.filename:
+        print ("***Error: The name of the journal file is required.")
+        sys.exit(-1)
+    if not os.path.isfile(args.filename):
+        # Create the file
+        if not createJournalFile(args.filename):
+            sys.exit(1)
+        else:
+            print ("Created journal file {}".format (args.filename))
+            cmd1 = cmd
 
-if cmd1 is None:
-    ok = do_recent(args.filename)
-    if ok:
-        sys.exit(0)
-    else:
+    # Open the journal once; every command below shares this connection.
+    jnl = Journal (args.filename, args.busy_timeout, args.synchronous)
+    if not jnl.open():
         sys.exit(1)
 
-
-# Stamp the command into the cmd_line table.
-ok = stamp_command (args.filename, cmd1)
-if not ok:
-    print ("*** Error: could not save command in cmd_line table")
-
+    try:
+        if args.batch:
+            ok = run_batch (jnl, parser, args)
+        elif args.replay:
+            ok = run_replay (jnl, parser, args)
+        elif args.shell:
+            ok = run_shell (jnl, parser, args)
+        elif args.serve:
+            ok = run_serve (jnl, parser, args)
+        else:
+            # run_parsed stamps the command, along with the creation of a new journal.
+            ok = run_parsed (jnl, args, cmd1)[0]
+            cmd1 = None
+        sys.stdout.flush ()
+    except BrokenPipeError:
+        # The reader went away (jnl ... | head). Stop quietly.
+        quiet_broken_pipe ()
+        jnl.close()
+        return 1
+
+    if cmd1 is not None:
+        # A new journal opened straight into --batch, --replay, --shell or --serve: stamp its creation.
+        if not jnl.stamp_command (cmd1):
+            print ("*** Error: could not save command in cmd_line table")
+    jnl.close()
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit (main ())
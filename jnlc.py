@@ -0,0 +1,90 @@
+#!/usr/local/bin/python3.11 -S
+# -*- coding: utf-8 -*-
+# vim: et:sts=4:sw=4
+
+########################################################################################################################
+### jnlc - thin client for jnl --serve
+########################################################################################################################
+# Takes the same arguments as jnl.py and sends them to the jnl --serve daemon that has the journal open, then copies
+# the output back and exits with the command's exit code. The socket is $JNL_SOCKET, or FILE.sock for the first
+# argument that names a served journal. With no server running, jnl.py is run directly instead.
+#
+#   jnl.py main.jnl --serve &
+#   jnlc.py main.jnl --add --log "took M3 and Noah to Sadies"
+#
+########################################################################################################################
+# Startup time is the whole cost of a client, so it skips site (-S) and uses the C modules under socket and json,
+# which on their own import in a fraction of the time.
+import sys
+import os
+import _socket
+from _json import encode_basestring_ascii as json_str
+
+########################################################################################################################
+### find_socket
+########################################################################################################################
+def find_socket (argv: list) -> str:
+    """Return the socket of the server for this command-line, or None."""
+    if os.environ.get ('JNL_SOCKET'):
+        return os.environ['JNL_SOCKET']
+    for a in argv:
+        if not a.startswith ('-') and os.path.exists (a + '.sock'):
+            return a + '.sock'
+    return None
+
+########################################################################################################################
+### run_local
+########################################################################################################################
+def run_local (argv: list) -> None:
+    """No server: run jnl.py (next to this script) in this process's place."""
+    jnl = os.path.join (os.path.dirname (os.path.abspath (__file__)), 'jnl.py')
+    os.execv (sys.executable, [sys.executable, jnl] + argv)
+
+########################################################################################################################
+### main
+########################################################################################################################
+def main () -> int:
+    argv = sys.argv[1:]
+    path = find_socket (argv)
+    if path is None:
+        run_local (argv)
+    s = _socket.socket (_socket.AF_UNIX, _socket.SOCK_STREAM)
+    try:
+        s.connect (path)
+    except OSError:
+        s.close()
+        run_local (argv)
+    req = '{{"argv": [{}], "cwd": {}}}\n'.format (', '.join ([json_str (a) for a in argv]), json_str (os.getcwd()))
+    s.sendall (req.encode ('ascii'))
+    # Output streams back as it is written; a NUL and the exit code end it.
+    out = sys.stdout.buffer
+    tail = b''
+    while True:
+        b = s.recv (65536)
+        if not b:
+            break
+        b = tail + b
+        i = b.rfind (b'\0')
+        if i < 0:
+            # Hold back a byte in case it is the start of the trailer.
+            out.write (b[:-1])
+            tail = b[-1:]
+            continue
+        out.write (b[:i])
+        tail = b[i:]
+    s.close()
+    out.flush ()
+    if not tail.startswith (b'\0'):
+        print ("*** Error: the jnl server on {} closed the connection".format (path))
+        return 1
+    try:
+        return int (tail[1:].decode().strip() or 0)
+    except ValueError:
+        return 1
+
+if __name__ == '__main__':
+    try:
+        sys.exit (main ())
+    except BrokenPipeError:
+        os.dup2 (os.open (os.devnull, os.O_WRONLY), sys.stdout.fileno ())
+        sys.exit (1)